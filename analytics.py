@@ -0,0 +1,186 @@
+"""Trend and anomaly analytics over a user's stored history.
+
+Per-cycle vitals are loaded from the normalized entity tables as column
+arrays and compared with each user's rolling baseline using NumPy. Results
+are cached per user, and when new cycles land only the tail of the arrays is
+recomputed. The cache only keeps the rows that recomputing the tail and the
+latest signals need, so its size does not grow with a user's history.
+"""
+import threading
+
+import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
+
+# Metric name -> direction of an adverse change (+1 higher is worse, -1 lower is worse)
+METRICS = {
+    'hrv_rmssd_milli': -1,
+    'resting_heart_rate': 1,
+    'respiratory_rate': 1,
+    'skin_temp_celsius': 1,
+    'spo2_percentage': -1,
+}
+
+# Vitals of every stored cycle from cycle_id onwards, one column per metric
+CYCLE_METRICS_QUERY = """
+SELECT c.id,
+       r.hrv_rmssd_milli,
+       r.resting_heart_rate,
+       s.respiratory_rate,
+       r.skin_temp_celsius,
+       r.spo2_percentage
+FROM cycles c
+LEFT JOIN recoveries r ON r.cycle_id = c.id
+LEFT JOIN sleeps s ON s.id = r.sleep_id
+WHERE c.whoop_id = ? AND c.id >= ?
+ORDER BY c.id
+"""
+
+
+def rolling_baseline(values, start, window, min_periods):
+    """Return mean and std of the ``window`` rows preceding each row from ``start``.
+
+    ``values`` is a 2-D array (cycles x metrics) with NaN for missing values.
+    A baseline is NaN unless at least ``min_periods`` values are present.
+    """
+    n, m = values.shape
+    lo = start - window
+    block = values[max(lo, 0):n - 1]
+    if lo < 0:
+        block = np.concatenate([np.full((-lo, m), np.nan), block])
+    windows = sliding_window_view(block, window, axis=0)
+
+    present = ~np.isnan(windows)
+    counts = present.sum(axis=-1)
+    filled = np.where(present, windows, 0.0)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean = filled.sum(axis=-1) / counts
+        deviations = np.where(present, windows - mean[..., None], 0.0)
+        std = np.sqrt((deviations ** 2).sum(axis=-1) / (counts - 1))
+    too_few = counts < min_periods
+    mean[too_few] = np.nan
+    std[too_few] = np.nan
+    return mean, std
+
+
+class TrendAnalyzer:
+    """Rolling-baseline z-scores and illness/overtraining signals per user."""
+
+    def __init__(self, window=28, min_periods=7, z_threshold=2.0,
+                 illness_threshold=1.5, overtraining_cycles=3):
+        self.window = window
+        self.min_periods = min_periods
+        self.z_threshold = z_threshold
+        self.illness_threshold = illness_threshold
+        self.overtraining_cycles = overtraining_cycles
+        self._directions = np.array(list(METRICS.values()), dtype=float)
+        # Rows kept per user: a full baseline window before the open cycle,
+        # and enough scored cycles for the overtraining check
+        self._keep = max(window + 1, overtraining_cycles)
+        self._users = {}
+        self._user_locks = {}
+        self._lock = threading.Lock()  # Guards _user_locks only
+
+    def _compute_tail(self, state, start):
+        """Recompute baselines and z-scores for rows from ``start`` onwards."""
+        values = state['values']
+        mean, std = rolling_baseline(values, start, self.window, self.min_periods)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            z = (values[start:] - mean) / std
+        z[~np.isfinite(z)] = np.nan
+        for key, tail in (('mean', mean), ('std', std), ('z', z)):
+            state[key] = np.concatenate([state[key][:start], tail])
+        if len(state['cycle_ids']) > self._keep:
+            for key in state:
+                state[key] = state[key][-self._keep:].copy()
+
+    def _user_lock(self, whoop_id):
+        with self._lock:
+            lock = self._user_locks.get(whoop_id)
+            if lock is None:
+                lock = self._user_locks[whoop_id] = threading.Lock()
+            return lock
+
+    def update(self, conn, whoop_id):
+        """Bring a user's cached arrays up to date and return their state.
+
+        The last cached cycle is reloaded along with any newer ones, since its
+        recovery and sleep can still change while it is open. Only requests
+        for the same user wait for each other. The returned state is a copy
+        that later updates don't change.
+        """
+        with self._user_lock(whoop_id):
+            state = self._users.get(whoop_id)
+            since = int(state['cycle_ids'][-1]) if state else 0
+            rows = conn.execute(CYCLE_METRICS_QUERY, (whoop_id, since)).fetchall()
+            if not rows:
+                return dict(state) if state else None
+
+            cycle_ids = np.array([row[0] for row in rows], dtype=np.int64)
+            values = np.array([row[1:] for row in rows], dtype=float)
+            if state is None:
+                state = {
+                    'cycle_ids': cycle_ids,
+                    'values': values,
+                    'mean': np.empty((0, len(METRICS))),
+                    'std': np.empty((0, len(METRICS))),
+                    'z': np.empty((0, len(METRICS))),
+                }
+                self._compute_tail(state, 0)
+                self._users[whoop_id] = state
+                return dict(state)
+
+            start = len(state['cycle_ids']) - 1
+            if (len(rows) == 1
+                    and np.array_equal(values[0], state['values'][start], equal_nan=True)):
+                return dict(state)
+
+            state['cycle_ids'] = np.concatenate([state['cycle_ids'][:start], cycle_ids])
+            state['values'] = np.concatenate([state['values'][:start], values])
+            self._compute_tail(state, start)
+            return dict(state)
+
+    def forget(self, whoop_id):
+        """Drop a user's cached arrays."""
+        with self._user_lock(whoop_id):
+            self._users.pop(whoop_id, None)
+        with self._lock:
+            self._user_locks.pop(whoop_id, None)
+
+    def summary(self, conn, whoop_id):
+        """Return z-scores and risk flags for the user's latest cycle."""
+        state = self.update(conn, whoop_id)
+        if state is None:
+            return None
+
+        # Positive adverse scores mean "worse than baseline" for every metric
+        adverse = state['z'] * self._directions
+        latest = adverse[-1]
+        illness_markers = np.nansum(latest >= self.illness_threshold)
+        recent = adverse[-self.overtraining_cycles:]
+        # HRV suppressed and resting heart rate elevated for several cycles in a row
+        overtraining = (
+            len(recent) == self.overtraining_cycles
+            and bool(np.all((recent[:, 0] >= 1.0) & (recent[:, 1] >= 1.0)))
+        )
+
+        metrics = {}
+        for i, name in enumerate(METRICS):
+            metrics[name] = {
+                'value': _float(state['values'][-1, i]),
+                'baseline_mean': _float(state['mean'][-1, i]),
+                'baseline_std': _float(state['std'][-1, i]),
+                'z_score': _float(state['z'][-1, i]),
+                'anomaly': bool(abs(state['z'][-1, i]) >= self.z_threshold),
+            }
+
+        return {
+            'cycle_id': int(state['cycle_ids'][-1]),
+            'baseline_cycles': self.window,
+            'metrics': metrics,
+            'illness_risk': bool(illness_markers >= 2),
+            'overtraining_risk': overtraining,
+        }
+
+
+def _float(value):
+    return None if np.isnan(value) else round(float(value), 3)
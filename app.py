@@ -1,4 +1,4 @@
-from flask import Flask, request, redirect, session, url_for, jsonify
+from flask import Flask, Blueprint, request, redirect, session, url_for, jsonify, Response, stream_with_context
 import os
 import requests
 from datetime import datetime, timezone, timedelta
@@ -11,41 +11,279 @@ import threading
 import time
 import sqlite3
 from functools import wraps
+from contextlib import contextmanager
+from concurrent.futures import TimeoutError as FutureTimeoutError
 import secrets
 import base64
+import csv
+import io
+import shutil
+import zlib
+import atexit
 
-# Load environment variables
-load_dotenv(os.path.join(os.getenv('CONFIG_DIR', './config'), '.env'))
+import archive
+from circuit_breaker import CircuitBreaker, CircuitOpenError, OPEN
+from db_writer import BatchWriter
+from logging_utils import current_user, start_queue_logging
+from profiling import Profiler
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
-log_file = os.getenv('LOG_FILE', '/app/data/whoop.log')
-os.makedirs(os.path.dirname(log_file), exist_ok=True)
-handler = RotatingFileHandler(log_file, maxBytes=10000000, backupCount=5)
-handler.setFormatter(logging.Formatter(
-    '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
-))
-logger.addHandler(handler)
-
-app = Flask(__name__)
-app.secret_key = os.getenv('FLASK_SECRET_KEY')
-API_TOKEN = os.getenv('API_TOKEN')
-
-# Whoop API Configuration
-WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
-WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
-WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+bp = Blueprint('whoop', __name__)
+
+# Whoop API endpoints
 WHOOP_AUTH_URL = 'https://api.prod.whoop.com/oauth/oauth2/auth'
 WHOOP_TOKEN_URL = 'https://api.prod.whoop.com/oauth/oauth2/token'
 WHOOP_API_BASE = 'https://api.prod.whoop.com/developer/v1'
 
-# Database configuration
-DB_PATH = os.getenv('SQLITE_DB', '/app/data/whoop.db')
-os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+def load_settings():
+    """Read configuration from the environment into module settings.
+
+    Only reads environment variables, so it is cheap enough to run at import.
+    create_app() runs it again after loading the .env file.
+    """
+    global API_TOKEN, FLASK_SECRET_KEY, LOG_FILE
+    global WHOOP_CLIENT_ID, WHOOP_CLIENT_SECRET, WHOOP_REDIRECT_URI
+    global UPSTREAM_TIMEOUT, TOKEN_TIMEOUT, whoop_circuit
+    global DB_PATH, STORAGE_MODE, SHARD_DIR, SHARD_COUNT, ARCHIVE_DIR, ARCHIVE_AFTER_DAYS, ARCHIVE_INTERVAL
+    global ANALYTICS_WINDOW, ANALYTICS_MIN_PERIODS, ANALYTICS_Z_THRESHOLD
+    global EXPORT_BATCH_SIZE
+    global profiler, db_writer
+
+    API_TOKEN = os.getenv('API_TOKEN')
+    FLASK_SECRET_KEY = os.getenv('FLASK_SECRET_KEY')
+    LOG_FILE = os.getenv('LOG_FILE', '/app/data/whoop.log')
+
+    # Whoop API Configuration
+    WHOOP_CLIENT_ID = os.getenv('WHOOP_CLIENT_ID')
+    WHOOP_CLIENT_SECRET = os.getenv('WHOOP_CLIENT_SECRET')
+    WHOOP_REDIRECT_URI = os.getenv('WHOOP_REDIRECT_URI')
+
+    # Upstream resilience
+    UPSTREAM_TIMEOUT = float(os.getenv('UPSTREAM_TIMEOUT', '10'))  # Seconds per Whoop API call
+    # Once a token request has been sent Whoop may already have rotated the
+    # refresh token, so its response is waited for much longer than the
+    # connect timeout
+    TOKEN_TIMEOUT = float(os.getenv('TOKEN_TIMEOUT', '120'))
+    whoop_circuit = CircuitBreaker(
+        failure_threshold=int(os.getenv('CIRCUIT_FAILURE_THRESHOLD', '5')),
+        reset_timeout=int(os.getenv('CIRCUIT_RESET_TIMEOUT', '60'))  # Seconds before a half-open probe
+    )
+
+    # Database configuration
+    DB_PATH = os.getenv('SQLITE_DB', '/app/data/whoop.db')
+
+    # History storage: 'single' keeps everything in DB_PATH, 'user' gives each
+    # user their own file and 'hash' spreads users over SHARD_COUNT files.
+    # DB_PATH then only holds the users and tokens catalog.
+    STORAGE_MODE = os.getenv('STORAGE_MODE', 'single')
+    if STORAGE_MODE not in ('single', 'user', 'hash'):
+        raise ValueError(f"Unknown STORAGE_MODE {STORAGE_MODE!r}, expected single, user or hash")
+    SHARD_DIR = os.getenv('SHARD_DIR', os.path.join(os.path.dirname(DB_PATH), 'shards'))
+    SHARD_COUNT = int(os.getenv('SHARD_COUNT', '16'))
+
+    # Cold archive configuration
+    ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', os.path.join(os.path.dirname(DB_PATH), 'archive'))
+    ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))  # 0 disables archiving
+    ARCHIVE_INTERVAL = int(os.getenv('ARCHIVE_INTERVAL', '86400'))  # Seconds between archive runs
+
+    # Rolling baselines for trend and anomaly analytics
+    ANALYTICS_WINDOW = int(os.getenv('ANALYTICS_WINDOW', '28'))  # Cycles in each user's baseline
+    ANALYTICS_MIN_PERIODS = int(os.getenv('ANALYTICS_MIN_PERIODS', '7'))
+    ANALYTICS_Z_THRESHOLD = float(os.getenv('ANALYTICS_Z_THRESHOLD', '2.0'))
+
+    # Rows fetched from SQLite per round trip while streaming an export
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '500'))
+
+    # Opt-in profiling: off, request, sample or all
+    profiler = Profiler(
+        mode=os.getenv('PROFILE_MODE', 'off'),
+        sample_rate=float(os.getenv('PROFILE_SAMPLE_RATE', '0.01')),
+        output_dir=os.getenv('PROFILE_DIR', os.path.join(os.path.dirname(DB_PATH), 'profiles'))
+    )
+
+    # Snapshot and token writes are group-committed by writer threads. The
+    # catalog gets its own, so a busy shard never holds up token writes.
+    db_writer = BatchWriter(
+        max_batch=int(os.getenv('WRITE_BATCH_SIZE', '100')),  # Writes per transaction at most
+        max_delay=float(os.getenv('WRITE_BATCH_DELAY_MS', '5')) / 1000,  # Wait for more writes after the first
+        workers=int(os.getenv('WRITE_WORKERS', '4')),  # Writer threads shared by the history files
+        dedicated=(DB_PATH,),
+        max_connections=int(os.getenv('WRITE_MAX_CONNECTIONS', '64')),  # Open files per writer thread
+        max_queue=int(os.getenv('WRITE_MAX_QUEUE', '10000')),  # Queued writes per writer thread
+        observe=profile_write_batch,
+        logger=logger
+    )
+
+@contextmanager
+def profile_write_batch(path, count):
+    """Record each group commit as its own operation, timed as db_write."""
+    with profiler.operation('write_batch', full=profiler.should_profile()), profiler.phase('db_write'):
+        yield
+
+load_settings()
+atexit.register(lambda: db_writer.stop())
+
+def configure_logging():
+    """Send the app logger's records through a background queue.
+
+    The console and rotating file handlers run on the queue's listener
+    thread, and repeated warnings and errors are deduplicated.
+    """
+    if logger.handlers:
+        return
+    logging.basicConfig(level=logging.INFO)
+    logger.setLevel(logging.INFO)
+    os.makedirs(os.path.dirname(LOG_FILE), exist_ok=True)
+    formatter = logging.Formatter(
+        '%(asctime)s %(levelname)s: %(message)s [in %(pathname)s:%(lineno)d]'
+    )
+    file_handler = RotatingFileHandler(LOG_FILE, maxBytes=10000000, backupCount=5)
+    file_handler.setFormatter(formatter)
+    console_handler = logging.StreamHandler()
+    console_handler.setFormatter(formatter)
+    start_queue_logging(
+        logger,
+        [console_handler, file_handler],
+        dedupe_window=int(os.getenv('LOG_DEDUPE_WINDOW', '300'))  # Seconds, 0 disables
+    )
+
+_db_ready = False
+_db_lock = threading.Lock()
+
+def ensure_db():
+    """Create the database schema on first use."""
+    global _db_ready
+    if not _db_ready:
+        with _db_lock:
+            if not _db_ready:
+                os.makedirs(os.path.dirname(DB_PATH), exist_ok=True)
+                init_db()
+                _db_ready = True
+
+def connect_db():
+    """Open a connection to the database, creating the schema on first use."""
+    ensure_db()
+    return sqlite3.connect(DB_PATH)
+
+_shards_ready = set()
+
+def shard_path(whoop_id):
+    """Return the database file holding a user's history in sharded storage."""
+    whoop_id = int(whoop_id)
+    if STORAGE_MODE == 'user':
+        return os.path.join(SHARD_DIR, f"user_{whoop_id}.db")
+    bucket = zlib.crc32(str(whoop_id).encode()) % SHARD_COUNT
+    return os.path.join(SHARD_DIR, f"shard_{bucket:03d}.db")
+
+def user_db_path(whoop_id, create=False):
+    """Return the database file holding a user's snapshots and entities.
+
+    In single-file storage this is the main database. In sharded storage it
+    is the user's shard, created with its schema when create is set.
+    Returns None if the shard does not exist and create is not set.
+    """
+    if STORAGE_MODE == 'single':
+        ensure_db()
+        return DB_PATH
+    path = shard_path(whoop_id)
+    if path not in _shards_ready:
+        if not create and not os.path.exists(path):
+            return None
+        ensure_shard(path)
+    return path
+
+def ensure_shard(path):
+    """Create a shard's schema on first use in this process."""
+    if path in _shards_ready:
+        return
+    with _db_lock:
+        if path not in _shards_ready:
+            os.makedirs(SHARD_DIR, exist_ok=True)
+            with sqlite3.connect(path) as conn:
+                conn.execute("PRAGMA journal_mode=WAL")
+                init_data_schema(conn)
+                conn.commit()
+            _shards_ready.add(path)
+
+def connect_user_db(whoop_id, create=False):
+    """Open the database returned by user_db_path(), or return None."""
+    path = user_db_path(whoop_id, create)
+    return sqlite3.connect(path) if path else None
+
+HISTORY_TABLES = ('whoop_data', 'cycles', 'recoveries', 'sleeps', 'workouts')
+
+def delete_rows(conn, whoop_id, tables):
+    for table in tables:
+        conn.execute(f"DELETE FROM {table} WHERE whoop_id = ?", (whoop_id,))
+
+def delete_user(whoop_id):
+    """Remove a user's tokens, profile, history and archive.
+
+    Deletes go through the writer after anything already queued for the
+    user, and no refresh for the user can run in this process meanwhile, so
+    nothing writes the user back afterwards.
+    """
+    whoop_id = int(whoop_id)
+    key = str(whoop_id)
+    # Wait for a running refresh to finish and keep new ones from starting
+    while True:
+        with _refreshing_lock:
+            if key not in _refreshing:
+                _refreshing.add(key)
+                break
+        time.sleep(0.1)
+
+    try:
+        ensure_db()
+        db_writer.submit(DB_PATH, delete_rows, whoop_id, ('tokens', 'users'), must_land=True).result()
+
+        if STORAGE_MODE == 'user':
+            path = shard_path(whoop_id)
+            # Let queued writes land, then make the writer let go of the file
+            db_writer.release(path).result()
+            with _db_lock:
+                _shards_ready.discard(path)
+                for suffix in ('', '-wal', '-shm', '-journal'):
+                    try:
+                        os.remove(path + suffix)
+                    except FileNotFoundError:
+                        pass
+        else:
+            path = user_db_path(whoop_id)
+            if path is not None:
+                db_writer.submit(path, delete_rows, whoop_id, HISTORY_TABLES, must_land=True).result()
+
+        shutil.rmtree(os.path.join(ARCHIVE_DIR, key), ignore_errors=True)
+        if _trend_analyzer is not None:
+            _trend_analyzer.forget(whoop_id)
+    finally:
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+_trend_analyzer = None
+
+def get_trend_analyzer():
+    """Return the shared trend analyzer, importing NumPy on first use."""
+    global _trend_analyzer
+    if _trend_analyzer is None:
+        import analytics
+        _trend_analyzer = analytics.TrendAnalyzer(
+            window=ANALYTICS_WINDOW,
+            min_periods=ANALYTICS_MIN_PERIODS,
+            z_threshold=ANALYTICS_Z_THRESHOLD
+        )
+    return _trend_analyzer
 
 def init_db():
+    """Create the catalog schema. Called once by connect_db().
+
+    In single-file storage the catalog database also holds every user's
+    snapshot and entity tables.
+    """
     with sqlite3.connect(DB_PATH) as conn:
+        # WAL lets long reads such as a slow /export run alongside the writer
+        conn.execute("PRAGMA journal_mode=WAL")
         conn.execute("""
         CREATE TABLE IF NOT EXISTS users (
             whoop_id INTEGER PRIMARY KEY,
@@ -71,33 +309,346 @@ def init_db():
             FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
         )
         """)
-        
-        conn.execute("""
-        CREATE TABLE IF NOT EXISTS whoop_data (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            whoop_id INTEGER,
-            timestamp TIMESTAMP,
-            cycle_id INTEGER,
-            cycle_data TEXT,
-            recovery_data TEXT,
-            sleep_data TEXT,
-            workout_data TEXT,
-            recovery_score INTEGER,
-            sleep_score INTEGER,
-            strain_score REAL,
-            calories_burned INTEGER,
-            average_heart_rate INTEGER,
-            max_heart_rate INTEGER,
-            respiratory_rate REAL,
-            spo2_percentage REAL,
-            skin_temp_celsius REAL,
-            FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
-        )
-        """)
+
+        if STORAGE_MODE == 'single':
+            init_data_schema(conn)
         conn.commit()
 
-# Initialize database
-init_db()
+def init_data_schema(conn):
+    """Create the snapshot and entity tables that hold a user's history."""
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS whoop_data (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        whoop_id INTEGER,
+        timestamp TIMESTAMP,
+        cycle_id INTEGER,
+        cycle_data TEXT,
+        recovery_data TEXT,
+        sleep_data TEXT,
+        workout_data TEXT,
+        recovery_score INTEGER,
+        sleep_score INTEGER,
+        strain_score REAL,
+        calories_burned INTEGER,
+        average_heart_rate INTEGER,
+        max_heart_rate INTEGER,
+        respiratory_rate REAL,
+        spo2_percentage REAL,
+        skin_temp_celsius REAL,
+        FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
+    )
+    """)
+
+    # Range scans for /data and /export
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_whoop_data_user_time
+    ON whoop_data (whoop_id, timestamp)
+    """)
+
+    # Per-cycle grouping for archiving
+    conn.execute("""
+    CREATE INDEX IF NOT EXISTS idx_whoop_data_user_cycle
+    ON whoop_data (whoop_id, cycle_id)
+    """)
+
+    # Normalized entity store, one row per Whoop object
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS cycles (
+        id INTEGER PRIMARY KEY,
+        whoop_id INTEGER,
+        start_time TEXT,
+        end_time TEXT,
+        timezone_offset TEXT,
+        score_state TEXT,
+        strain REAL,
+        kilojoule REAL,
+        average_heart_rate INTEGER,
+        max_heart_rate INTEGER,
+        data TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS recoveries (
+        cycle_id INTEGER PRIMARY KEY,
+        whoop_id INTEGER,
+        sleep_id INTEGER,
+        score_state TEXT,
+        recovery_score REAL,
+        resting_heart_rate REAL,
+        hrv_rmssd_milli REAL,
+        spo2_percentage REAL,
+        skin_temp_celsius REAL,
+        data TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (whoop_id) REFERENCES users(whoop_id),
+        FOREIGN KEY (cycle_id) REFERENCES cycles(id)
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS sleeps (
+        id INTEGER PRIMARY KEY,
+        whoop_id INTEGER,
+        start_time TEXT,
+        end_time TEXT,
+        nap INTEGER,
+        score_state TEXT,
+        sleep_performance_percentage REAL,
+        respiratory_rate REAL,
+        data TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
+    )
+    """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS workouts (
+        id INTEGER PRIMARY KEY,
+        whoop_id INTEGER,
+        start_time TEXT,
+        end_time TEXT,
+        sport_id INTEGER,
+        score_state TEXT,
+        strain REAL,
+        kilojoule REAL,
+        average_heart_rate INTEGER,
+        max_heart_rate INTEGER,
+        distance_meter REAL,
+        data TEXT,
+        created_at TEXT,
+        updated_at TEXT,
+        FOREIGN KEY (whoop_id) REFERENCES users(whoop_id)
+    )
+    """)
+
+    # Sleeps and workouts belong to the cycle whose time range contains their start
+    for table in ('cycles', 'sleeps', 'workouts'):
+        conn.execute(f"""
+        CREATE INDEX IF NOT EXISTS idx_{table}_user_start
+        ON {table} (whoop_id, start_time)
+        """)
+
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS meta (
+        key TEXT PRIMARY KEY,
+        value TEXT
+    )
+    """)
+
+    mark_backfill_state(conn)
+
+# PRAGMA user_version values tracking the entity backfill
+BACKFILL_PENDING = 1
+BACKFILL_DONE = 2
+BACKFILL_BATCH_SIZE = 500
+
+def mark_backfill_state(conn):
+    """Record whether the entity tables still need backfilling from snapshots.
+
+    The backfill itself runs from the background thread, see
+    backfill_pending_entities().
+    """
+    if conn.execute("PRAGMA user_version").fetchone()[0] >= BACKFILL_PENDING:
+        return
+    needed = (
+        conn.execute("SELECT 1 FROM whoop_data LIMIT 1").fetchone()
+        and not conn.execute("SELECT 1 FROM cycles LIMIT 1").fetchone()
+    )
+    conn.execute(f"PRAGMA user_version = {BACKFILL_PENDING if needed else BACKFILL_DONE}")
+
+def backfill_entities(path):
+    """Backfill one database's entity tables from its existing snapshots.
+
+    Each batch of BACKFILL_BATCH_SIZE snapshots is claimed and committed
+    under the write lock together with the last id it reached, so an
+    interrupted backfill resumes where it stopped and workers running it at
+    the same time never repeat each other's batches. Returns the number of
+    snapshots backfilled.
+    """
+    backfilled = 0
+    conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+    try:
+        while conn.execute("PRAGMA user_version").fetchone()[0] == BACKFILL_PENDING:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                row = conn.execute("SELECT value FROM meta WHERE key = 'backfill_last_id'").fetchone()
+                rows = conn.execute("""
+                SELECT id, whoop_id, cycle_data, recovery_data, sleep_data, workout_data
+                FROM whoop_data WHERE id > ? ORDER BY id LIMIT ?
+                """, (int(row[0]) if row else 0, BACKFILL_BATCH_SIZE)).fetchall()
+                for _, whoop_id, *documents in rows:
+                    save_entities(conn, whoop_id, dict(zip(
+                        ('cycle', 'recovery', 'sleep', 'workout'),
+                        (json.loads(doc) if doc else None for doc in documents)
+                    )))
+                if rows:
+                    conn.execute(
+                        "INSERT OR REPLACE INTO meta (key, value) VALUES ('backfill_last_id', ?)",
+                        (rows[-1][0],)
+                    )
+                else:
+                    conn.execute(f"PRAGMA user_version = {BACKFILL_DONE}")
+                conn.execute("COMMIT")
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            backfilled += len(rows)
+    finally:
+        conn.close()
+    return backfilled
+
+def backfill_pending_entities():
+    """Run any pending entity backfill, in the main database or the shards."""
+    ensure_db()
+    if STORAGE_MODE == 'single':
+        paths = [DB_PATH]
+    else:
+        try:
+            names = sorted(os.listdir(SHARD_DIR))
+        except FileNotFoundError:
+            names = []
+        paths = [os.path.join(SHARD_DIR, name) for name in names if name.endswith('.db')]
+
+    for path in paths:
+        if path != DB_PATH:
+            ensure_shard(path)
+        backfilled = backfill_entities(path)
+        if backfilled:
+            logger.info(f"Backfilled entities from {backfilled} snapshots in {path}")
+
+def upsert_entity(conn, table, key, values):
+    """Insert a Whoop object, or update it if the stored copy is older.
+
+    The row is only overwritten when the incoming updated_at is newer, so
+    replaying an old snapshot never clobbers fresher data.
+    """
+    columns = list(values)
+    assignments = ', '.join(f"{column} = excluded.{column}" for column in columns if column != key)
+    conn.execute(f"""
+    INSERT INTO {table} ({', '.join(columns)})
+    VALUES ({', '.join('?' * len(columns))})
+    ON CONFLICT ({key}) DO UPDATE SET {assignments}
+    WHERE {table}.updated_at IS NULL OR excluded.updated_at > {table}.updated_at
+    """, list(values.values()))
+
+def save_entities(conn, whoop_id, data):
+    """Upsert the cycle, recovery, sleep and workout objects of a snapshot."""
+    cycle = data.get('cycle')
+    if cycle and cycle.get('id'):
+        score = cycle.get('score') or {}
+        upsert_entity(conn, 'cycles', 'id', {
+            'id': cycle['id'],
+            'whoop_id': whoop_id,
+            'start_time': cycle.get('start'),
+            'end_time': cycle.get('end'),
+            'timezone_offset': cycle.get('timezone_offset'),
+            'score_state': cycle.get('score_state'),
+            'strain': score.get('strain'),
+            'kilojoule': score.get('kilojoule'),
+            'average_heart_rate': score.get('average_heart_rate'),
+            'max_heart_rate': score.get('max_heart_rate'),
+            'data': json.dumps(cycle),
+            'created_at': cycle.get('created_at'),
+            'updated_at': cycle.get('updated_at')
+        })
+
+    recovery = data.get('recovery')
+    if recovery and recovery.get('cycle_id'):
+        score = recovery.get('score') or {}
+        upsert_entity(conn, 'recoveries', 'cycle_id', {
+            'cycle_id': recovery['cycle_id'],
+            'whoop_id': whoop_id,
+            'sleep_id': recovery.get('sleep_id'),
+            'score_state': recovery.get('score_state'),
+            'recovery_score': score.get('recovery_score'),
+            'resting_heart_rate': score.get('resting_heart_rate'),
+            'hrv_rmssd_milli': score.get('hrv_rmssd_milli'),
+            'spo2_percentage': score.get('spo2_percentage'),
+            'skin_temp_celsius': score.get('skin_temp_celsius'),
+            'data': json.dumps(recovery),
+            'created_at': recovery.get('created_at'),
+            'updated_at': recovery.get('updated_at')
+        })
+
+    for sleep in data.get('sleeps') or [data.get('sleep')]:
+        if not sleep or not sleep.get('id'):
+            continue
+        score = sleep.get('score') or {}
+        upsert_entity(conn, 'sleeps', 'id', {
+            'id': sleep['id'],
+            'whoop_id': whoop_id,
+            'start_time': sleep.get('start'),
+            'end_time': sleep.get('end'),
+            'nap': sleep.get('nap'),
+            'score_state': sleep.get('score_state'),
+            'sleep_performance_percentage': score.get('sleep_performance_percentage'),
+            'respiratory_rate': score.get('respiratory_rate'),
+            'data': json.dumps(sleep),
+            'created_at': sleep.get('created_at'),
+            'updated_at': sleep.get('updated_at')
+        })
+
+    for workout in data.get('workouts') or [data.get('workout')]:
+        if not workout or not workout.get('id'):
+            continue
+        score = workout.get('score') or {}
+        upsert_entity(conn, 'workouts', 'id', {
+            'id': workout['id'],
+            'whoop_id': whoop_id,
+            'start_time': workout.get('start'),
+            'end_time': workout.get('end'),
+            'sport_id': workout.get('sport_id'),
+            'score_state': workout.get('score_state'),
+            'strain': score.get('strain'),
+            'kilojoule': score.get('kilojoule'),
+            'average_heart_rate': score.get('average_heart_rate'),
+            'max_heart_rate': score.get('max_heart_rate'),
+            'distance_meter': score.get('distance_meter'),
+            'data': json.dumps(workout),
+            'created_at': workout.get('created_at'),
+            'updated_at': workout.get('updated_at')
+        })
+
+def get_cycle_entities(conn, whoop_id, cycle_id):
+    """Load a stored cycle with its recovery and the sleeps and workouts inside it."""
+    cycle = conn.execute(
+        "SELECT start_time, end_time, data FROM cycles WHERE id = ? AND whoop_id = ?",
+        (cycle_id, whoop_id)
+    ).fetchone()
+    if not cycle:
+        return None
+    start_time, end_time, cycle_data = cycle
+
+    recovery = conn.execute(
+        "SELECT data FROM recoveries WHERE cycle_id = ?", (cycle_id,)
+    ).fetchone()
+
+    # Open cycles have no end yet, so everything after their start belongs to them
+    window = "whoop_id = ? AND start_time >= ?"
+    params = [whoop_id, start_time]
+    if end_time:
+        window += " AND start_time < ?"
+        params.append(end_time)
+    sleeps = conn.execute(
+        f"SELECT data FROM sleeps WHERE {window} ORDER BY start_time", params
+    ).fetchall()
+    workouts = conn.execute(
+        f"SELECT data FROM workouts WHERE {window} ORDER BY start_time", params
+    ).fetchall()
+
+    return {
+        'cycle': json.loads(cycle_data),
+        'recovery': json.loads(recovery[0]) if recovery else None,
+        'sleeps': [json.loads(row[0]) for row in sleeps],
+        'workouts': [json.loads(row[0]) for row in workouts]
+    }
+
 
 def require_api_token(f):
     @wraps(f)
@@ -108,92 +659,130 @@ def require_api_token(f):
         return f(*args, **kwargs)
     return decorated_function
 
+def write_user(conn, user_info, token_info):
+    # Save user info
+    conn.execute("""
+    INSERT OR REPLACE INTO users (whoop_id, email, first_name, last_name)
+    VALUES (?, ?, ?, ?)
+    """, (user_info['id'], user_info.get('email'), 
+          user_info.get('first_name'), user_info.get('last_name')))
+    
+    # Save token info
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=token_info['expires_in'])
+    conn.execute("""
+    INSERT OR REPLACE INTO tokens (whoop_id, access_token, refresh_token, expires_at)
+    VALUES (?, ?, ?, ?)
+    """, (user_info['id'], token_info['access_token'], 
+          token_info['refresh_token'], expires_at))
+
 def save_user_data(user_info, token_info):
-    with sqlite3.connect(DB_PATH) as conn:
-        # Save user info
-        conn.execute("""
-        INSERT OR REPLACE INTO users (whoop_id, email, first_name, last_name)
-        VALUES (?, ?, ?, ?)
-        """, (user_info['id'], user_info.get('email'), 
-              user_info.get('first_name'), user_info.get('last_name')))
-        
-        # Save token info
-        expires_at = datetime.now(timezone.utc) + timedelta(seconds=token_info['expires_in'])
-        conn.execute("""
-        INSERT OR REPLACE INTO tokens (whoop_id, access_token, refresh_token, expires_at)
-        VALUES (?, ?, ?, ?)
-        """, (user_info['id'], token_info['access_token'], 
-              token_info['refresh_token'], expires_at))
-        
-        conn.commit()
+    """Save a user's profile and tokens, waiting a while for the commit.
+
+    The write is retried until it lands, so a slow commit is only logged.
+    """
+    ensure_db()
+    with profiler.phase('db_write'):
+        future = db_writer.submit(
+            DB_PATH, write_user, user_info, token_info, must_land=True
+        )
+        try:
+            future.result(timeout=TOKEN_WRITE_WAIT)
+        except FutureTimeoutError:
+            logger.warning(f"Token write for user {user_info['id']} is still being retried")
+
+def write_snapshot(conn, whoop_id, data, vitals):
+    recovery_data = data.get('recovery', {})
+    sleep_data = data.get('sleep', {})
+    workout_data = data.get('workout', {})
+    cycle_data = data.get('cycle', {})
+
+    # Get scores
+    recovery_score = recovery_data.get('score', {}).get('recovery_score') if recovery_data else None
+    sleep_score = sleep_data.get('score', {}).get('sleep_score') if sleep_data else None
+    strain_score = cycle_data.get('score', {}).get('strain') if cycle_data else None
+
+    conn.execute("""
+    INSERT INTO whoop_data 
+    (whoop_id, timestamp, cycle_id, cycle_data, recovery_data, sleep_data, workout_data,
+     recovery_score, sleep_score, strain_score, calories_burned, average_heart_rate,
+     max_heart_rate, respiratory_rate, spo2_percentage, skin_temp_celsius)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+    """, (
+        whoop_id,
+        data['timestamp'],
+        data['cycle']['id'],
+        json.dumps(cycle_data),
+        json.dumps(recovery_data) if recovery_data else None,
+        json.dumps(sleep_data) if sleep_data else None,
+        json.dumps(workout_data) if workout_data else None,
+        recovery_score,
+        sleep_score,
+        strain_score,
+        vitals.get('calories_burned'),
+        vitals.get('average_heart_rate'),
+        vitals.get('max_heart_rate'),
+        vitals.get('respiratory_rate'),
+        vitals.get('spo2_percentage'),
+        vitals.get('skin_temp_celsius')
+    ))
+
+    save_entities(conn, whoop_id, data)
+
+def write_rest_heart_rate(conn, whoop_id, rest_heart_rate):
+    conn.execute("""
+    UPDATE users 
+    SET rest_heart_rate = ?, updated_at = CURRENT_TIMESTAMP 
+    WHERE whoop_id = ?
+    """, (rest_heart_rate, whoop_id))
+
+def log_write_error(future):
+    if future.exception() is not None:
+        logger.error(f"Failed to save data: {future.exception()}")
 
 def save_whoop_data_to_db(whoop_id, data):
-    with sqlite3.connect(DB_PATH) as conn:
-        # Extract metrics from the data
-        recovery_data = data.get('recovery', {})
-        sleep_data = data.get('sleep', {})
-        workout_data = data.get('workout', {})
-        cycle_data = data.get('cycle', {})
-
-        # Get scores and metrics
-        recovery_score = recovery_data.get('score', {}).get('recovery_score') if recovery_data else None
-        sleep_score = sleep_data.get('score', {}).get('sleep_score') if sleep_data else None
-        strain_score = cycle_data.get('score', {}).get('strain') if cycle_data else None
-        
-        # Get vital signs
-        vitals = {}
-        if recovery_data and recovery_data.get('score'):
-            vitals.update({
-                'respiratory_rate': recovery_data['score'].get('respiratory_rate'),
-                'spo2_percentage': recovery_data['score'].get('spo2_percentage'),
-                'skin_temp_celsius': recovery_data['score'].get('skin_temp_celsius'),
-                'rest_heart_rate': recovery_data['score'].get('resting_heart_rate')
-            })
-        
-        if workout_data and workout_data.get('score'):
-            vitals.update({
-                'calories_burned': workout_data['score'].get('kilojoule'),
-                'average_heart_rate': workout_data['score'].get('average_heart_rate'),
-                'max_heart_rate': workout_data['score'].get('max_heart_rate')
-            })
+    """Queue a snapshot for the writer thread and return its future.
+
+    Callers don't need to wait: the snapshot is committed with whatever
+    other writes are pending, and failures are logged.
+    """
+    recovery_data = data.get('recovery', {})
+    workout_data = data.get('workout', {})
+
+    # Get vital signs
+    vitals = {}
+    if recovery_data and recovery_data.get('score'):
+        vitals.update({
+            'respiratory_rate': recovery_data['score'].get('respiratory_rate'),
+            'spo2_percentage': recovery_data['score'].get('spo2_percentage'),
+            'skin_temp_celsius': recovery_data['score'].get('skin_temp_celsius'),
+            'rest_heart_rate': recovery_data['score'].get('resting_heart_rate')
+        })
+    
+    if workout_data and workout_data.get('score'):
+        vitals.update({
+            'calories_burned': workout_data['score'].get('kilojoule'),
+            'average_heart_rate': workout_data['score'].get('average_heart_rate'),
+            'max_heart_rate': workout_data['score'].get('max_heart_rate')
+        })
+
+    # The commit happens later on a writer thread and shows up as its own
+    # write_batch operation, so this only times handing the write over
+    with profiler.phase('db_queue'):
+        future = db_writer.submit(
+            user_db_path(whoop_id, create=True), write_snapshot, whoop_id, data, vitals
+        )
+        future.add_done_callback(log_write_error)
 
-        conn.execute("""
-        INSERT INTO whoop_data 
-        (whoop_id, timestamp, cycle_id, cycle_data, recovery_data, sleep_data, workout_data,
-         recovery_score, sleep_score, strain_score, calories_burned, average_heart_rate,
-         max_heart_rate, respiratory_rate, spo2_percentage, skin_temp_celsius)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            whoop_id,
-            data['timestamp'],
-            data['cycle']['id'],
-            json.dumps(cycle_data),
-            json.dumps(recovery_data) if recovery_data else None,
-            json.dumps(sleep_data) if sleep_data else None,
-            json.dumps(workout_data) if workout_data else None,
-            recovery_score,
-            sleep_score,
-            strain_score,
-            vitals.get('calories_burned'),
-            vitals.get('average_heart_rate'),
-            vitals.get('max_heart_rate'),
-            vitals.get('respiratory_rate'),
-            vitals.get('spo2_percentage'),
-            vitals.get('skin_temp_celsius')
-        ))
-        
         # Update user's rest heart rate if available
         if vitals.get('rest_heart_rate'):
-            conn.execute("""
-            UPDATE users 
-            SET rest_heart_rate = ?, updated_at = CURRENT_TIMESTAMP 
-            WHERE whoop_id = ?
-            """, (vitals['rest_heart_rate'], whoop_id))
-        
-        conn.commit()
+            ensure_db()
+            db_writer.submit(
+                DB_PATH, write_rest_heart_rate, whoop_id, vitals['rest_heart_rate']
+            ).add_done_callback(log_write_error)
+    return future
 
 def get_user_token(whoop_id):
-    with sqlite3.connect(DB_PATH) as conn:
+    with connect_db() as conn:
         cursor = conn.execute("""
         SELECT access_token, refresh_token, expires_at
         FROM tokens WHERE whoop_id = ?
@@ -201,7 +790,7 @@ def get_user_token(whoop_id):
         return cursor.fetchone()
 
 def get_user_info(whoop_id=None):
-    with sqlite3.connect(DB_PATH) as conn:
+    with connect_db() as conn:
         if whoop_id:
             cursor = conn.execute("SELECT * FROM users WHERE whoop_id = ?", (whoop_id,))
             return cursor.fetchone()
@@ -209,52 +798,476 @@ def get_user_info(whoop_id=None):
             cursor = conn.execute("SELECT * FROM users")
             return cursor.fetchall()
 
-@app.route('/data')
+# Keys every /data response carries
+DATA_METADATA = ('user_id', 'timestamp', 'version', 'age_seconds', 'upstream_status')
+# Sections of the /data payload, in the order their digests appear in the version
+DATA_SECTIONS = (
+    'cycle_id', 'cycle', 'recovery', 'sleep', 'workout',
+    'sleeps', 'workouts', 'workout_summary', 'analytics'
+)
+
+def load_latest_snapshot(conn, whoop_id, sections=None):
+    """Build the /data payload from the user's most recent stored snapshot.
+
+    Only the named sections are built when sections is given, so clients that
+    don't ask for analytics or the cycle's sleeps and workouts don't pay for
+    them.
+    """
+    wanted = set(DATA_SECTIONS if sections is None else sections)
+    with profiler.phase('db_read'):
+        cursor = conn.execute("""
+        SELECT * FROM whoop_data 
+        WHERE whoop_id = ? 
+        ORDER BY timestamp DESC 
+        LIMIT 1
+        """, (whoop_id,))
+        data = cursor.fetchone()
+        if not data:
+            return None
+
+        entities = None
+        if wanted & {'sleeps', 'workouts', 'workout_summary'}:
+            entities = get_cycle_entities(conn, whoop_id, data[3])
+        workouts = entities['workouts'] if entities else []
+
+    trends = None
+    if 'analytics' in wanted:
+        try:
+            with profiler.phase('analytics'):
+                trends = get_trend_analyzer().summary(conn, whoop_id)
+        except Exception as e:
+            logger.error(f"Error computing analytics for user {whoop_id}: {e}")
+
+    age = datetime.now(timezone.utc) - datetime.fromisoformat(data[2])
+    builders = {
+        "cycle_id": lambda: data[3],
+        "cycle": lambda: json.loads(data[4]) if data[4] else None,
+        "recovery": lambda: json.loads(data[5]) if data[5] else None,
+        "sleep": lambda: json.loads(data[6]) if data[6] else None,
+        "workout": lambda: json.loads(data[7]) if data[7] else None,
+        "sleeps": lambda: entities['sleeps'] if entities else [],
+        "workouts": lambda: workouts,
+        "workout_summary": lambda: summarize_workouts(workouts),
+        "analytics": lambda: trends
+    }
+    snapshot = {
+        "user_id": data[1],
+        "timestamp": data[2],
+        "age_seconds": int(age.total_seconds()),
+        "upstream_status": whoop_circuit.state
+    }
+    for section in DATA_SECTIONS:
+        if section in wanted:
+            snapshot[section] = builders[section]()
+    return snapshot
+
+def read_latest_snapshot(whoop_id, sections=None):
+    """Load the /data payload for a user, or None if nothing is stored"""
+    conn = connect_user_db(whoop_id)
+    if conn is None:
+        return None
+    with conn:
+        return load_latest_snapshot(conn, whoop_id, sections)
+
+def parse_data_fields(value):
+    """Parse a fields= list of dotted paths into {section: [path, ...]}.
+
+    A bare section name selects the whole section, and * in a path matches
+    every key of an object. Returns None when no fields were given.
+    """
+    if not value:
+        return None
+    fields = {}
+    for field in value.split(','):
+        path = [part for part in field.strip().split('.') if part]
+        if not path or path[0] in DATA_METADATA:
+            continue
+        if path[0] not in DATA_SECTIONS:
+            raise ValueError(f"Unknown field {field.strip()!r}")
+        fields.setdefault(path[0], []).append(path[1:])
+    return fields
+
+def project_fields(value, paths):
+    """Keep only the parts of value named by paths, applying them to each list item."""
+    if any(not path for path in paths):
+        return value
+    if isinstance(value, list):
+        return [project_fields(item, paths) for item in value]
+    if not isinstance(value, dict):
+        return value
+    projected = {}
+    for key, item in value.items():
+        rest = [path[1:] for path in paths if path[0] in (key, '*')]
+        if rest:
+            projected[key] = project_fields(item, rest)
+    return projected
+
+def section_digest(value):
+    encoded = json.dumps(value, sort_keys=True, separators=(',', ':')).encode()
+    return f"{zlib.crc32(encoded):08x}"
+
+def select_sections(snapshot, fields=None, since=None):
+    """Project a snapshot and drop the sections unchanged since a client's version.
+
+    The version is the digest of every returned section, so a client that
+    sends it back as since= only gets sections whose content has changed.
+    A version that can't be parsed gets the full payload.
+    """
+    response = {key: snapshot[key] for key in DATA_METADATA if key in snapshot}
+    previous = None
+    if since and len(since) == 8 * len(DATA_SECTIONS):
+        previous = [since[i:i + 8] for i in range(0, len(since), 8)]
+
+    digests = []
+    for index, section in enumerate(DATA_SECTIONS):
+        if section not in snapshot:
+            digests.append('0' * 8)
+            continue
+        value = snapshot[section]
+        if fields and fields.get(section):
+            value = project_fields(value, fields[section])
+        digest = section_digest(value)
+        digests.append(digest)
+        if previous is None or previous[index] != digest:
+            response[section] = value
+    response['version'] = ''.join(digests)
+    return response
+
+@bp.route('/data')
 @require_api_token
 def get_data():
-    whoop_id = request.args.get('user_id')
+    whoop_id = request.args.get('user_id', type=int)
     if not whoop_id:
         return jsonify({"error": "user_id parameter is required"}), 400
+    try:
+        fields = parse_data_fields(request.args.get('fields'))
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
 
     try:
-        with sqlite3.connect(DB_PATH) as conn:
-            cursor = conn.execute("""
-            SELECT * FROM whoop_data 
-            WHERE whoop_id = ? 
-            ORDER BY timestamp DESC 
-            LIMIT 1
-            """, (whoop_id,))
-            data = cursor.fetchone()
-            
-            if not data:
-                return jsonify({"error": "No data found for user"}), 404
-                
-            return jsonify({
-                "user_id": data[1],
-                "timestamp": data[2],
-                "cycle_id": data[3],
-                "cycle": json.loads(data[4]) if data[4] else None,
-                "recovery": json.loads(data[5]) if data[5] else None,
-                "sleep": json.loads(data[6]) if data[6] else None,
-                "workout": json.loads(data[7]) if data[7] else None
-            })
+        data = read_latest_snapshot(whoop_id, fields.keys() if fields is not None else None)
+        if not data:
+            return jsonify({"error": "No data found for user"}), 404
+        return jsonify(select_sections(data, fields, request.args.get('since')))
     except Exception as e:
         logger.error(f"Error reading data: {e}")
         return jsonify({"error": "Error reading data"}), 500
 
-@app.route('/refresh')
+EXPORT_SCALAR_COLUMNS = [
+    'user_id', 'timestamp', 'cycle_id', 'recovery_score', 'sleep_score',
+    'strain_score', 'calories_burned', 'average_heart_rate', 'max_heart_rate',
+    'respiratory_rate', 'spo2_percentage', 'skin_temp_celsius'
+]
+EXPORT_DOCUMENT_COLUMNS = ['cycle', 'recovery', 'sleep', 'workout']
+# whoop_data columns backing the export fields above, in the same order
+EXPORT_ROW_COLUMNS = [
+    'whoop_id', 'timestamp', 'cycle_id', 'recovery_score', 'sleep_score',
+    'strain_score', 'calories_burned', 'average_heart_rate', 'max_heart_rate',
+    'respiratory_rate', 'spo2_percentage', 'skin_temp_celsius',
+    'cycle_data', 'recovery_data', 'sleep_data', 'workout_data'
+]
+
+def parse_export_bound(value, end=False):
+    """Parse a from/to query value into a UTC ISO timestamp.
+
+    Accepts a date (YYYY-MM-DD) or an ISO datetime. A bare date used as the
+    upper bound covers the whole day.
+    """
+    if not value:
+        return None
+    parsed = datetime.fromisoformat(value)
+    if len(value) == 10 and end:
+        parsed += timedelta(days=1)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.astimezone(timezone.utc).isoformat()
+
+def iter_export_rows(whoop_id, date_from=None, date_to=None):
+    """Yield stored snapshots for a user in timestamp order.
+
+    Archived snapshots come first, followed by the hot table. Rows are pulled
+    in batches from the archive segments and a server-side cursor, so memory
+    use does not depend on the size of the requested range.
+
+    The hot table's read snapshot is taken before the archive is read, so
+    rows the archive job moves in the meantime are still exported from the
+    hot table. Archived copies of rows that are in the snapshot are skipped.
+    """
+    conn = connect_user_db(whoop_id)
+    try:
+        if conn is not None:
+            conn.execute("BEGIN")
+            conn.execute("SELECT 1 FROM whoop_data LIMIT 1").fetchone()
+
+        batch = []
+        for record in archive.iter_rows(ARCHIVE_DIR, whoop_id, date_from, date_to):
+            batch.append(dict(zip(archive.COLUMNS, record)))
+            if len(batch) >= EXPORT_BATCH_SIZE:
+                yield archived_export_rows(conn, batch)
+                batch = []
+        if batch:
+            yield archived_export_rows(conn, batch)
+
+        if conn is None:
+            return
+        query = f"""
+        SELECT {', '.join(EXPORT_ROW_COLUMNS)}
+        FROM whoop_data
+        WHERE whoop_id = ?
+        """
+        params = [whoop_id]
+        if date_from:
+            query += " AND timestamp >= ?"
+            params.append(date_from)
+        if date_to:
+            query += " AND timestamp < ?"
+            params.append(date_to)
+        query += " ORDER BY timestamp"
+
+        cursor = conn.execute(query, params)
+        while True:
+            rows = cursor.fetchmany(EXPORT_BATCH_SIZE)
+            if not rows:
+                break
+            yield rows
+    finally:
+        if conn is not None:
+            conn.close()
+
+def archived_export_rows(conn, records):
+    """Turn archived records into export rows, minus those still in the hot snapshot."""
+    if conn is not None:
+        ids = [record['id'] for record in records]
+        hot = {row[0] for row in conn.execute(
+            f"SELECT id FROM whoop_data WHERE id IN ({','.join('?' * len(ids))})", ids
+        )}
+        records = [record for record in records if record['id'] not in hot]
+    return [tuple(record[column] for column in EXPORT_ROW_COLUMNS) for record in records]
+
+def format_ndjson_rows(rows):
+    """Render a batch of rows as NDJSON.
+
+    The stored documents are already JSON, so they are spliced into the
+    output as-is instead of being decoded and re-encoded.
+    """
+    lines = []
+    for row in rows:
+        scalars = json.dumps(dict(zip(EXPORT_SCALAR_COLUMNS, row[:12])))
+        documents = ','.join(
+            f'"{name}":{doc or "null"}'
+            for name, doc in zip(EXPORT_DOCUMENT_COLUMNS, row[12:])
+        )
+        lines.append(f"{scalars[:-1]},{documents}}}\n")
+    return ''.join(lines)
+
+def format_csv_rows(rows, writer, buffer):
+    """Render a batch of rows as CSV using a reusable writer and buffer."""
+    writer.writerows(rows)
+    chunk = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    return chunk
+
+@bp.route('/export')
+@require_api_token
+def export_data():
+    whoop_id = request.args.get('user_id', type=int)
+    if not whoop_id:
+        return jsonify({"error": "user_id parameter is required"}), 400
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({"error": "format must be 'ndjson' or 'csv'"}), 400
+
+    try:
+        date_from = parse_export_bound(request.args.get('from'))
+        date_to = parse_export_bound(request.args.get('to'), end=True)
+    except ValueError:
+        return jsonify({"error": "from/to must be ISO dates or datetimes"}), 400
+
+    def generate():
+        try:
+            if export_format == 'csv':
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                header = EXPORT_SCALAR_COLUMNS + EXPORT_DOCUMENT_COLUMNS
+                yield format_csv_rows([header], writer, buffer)
+                for rows in iter_export_rows(whoop_id, date_from, date_to):
+                    yield format_csv_rows(rows, writer, buffer)
+            else:
+                for rows in iter_export_rows(whoop_id, date_from, date_to):
+                    yield format_ndjson_rows(rows)
+        except Exception as e:
+            # Headers are already sent, so the stream can only be cut short
+            logger.error(f"Error streaming export for user {whoop_id}: {e}")
+
+    mimetype = 'text/csv' if export_format == 'csv' else 'application/x-ndjson'
+    filename = f"whoop_{whoop_id}.{export_format}"
+    return Response(
+        stream_with_context(generate()),
+        mimetype=mimetype,
+        headers={
+            'Content-Disposition': f'attachment; filename="{filename}"',
+            # Stop reverse proxies from buffering the whole export
+            'X-Accel-Buffering': 'no'
+        }
+    )
+
+# Per-cycle metrics served by /history, oldest first
+HISTORY_QUERY = """
+SELECT c.id, c.start_time, c.end_time, c.strain, c.kilojoule,
+       c.average_heart_rate, c.max_heart_rate,
+       r.recovery_score, r.resting_heart_rate, r.hrv_rmssd_milli,
+       r.spo2_percentage, r.skin_temp_celsius,
+       s.sleep_performance_percentage, s.respiratory_rate
+FROM cycles c
+LEFT JOIN recoveries r ON r.cycle_id = c.id
+LEFT JOIN sleeps s ON s.id = r.sleep_id
+WHERE c.whoop_id = ? AND c.start_time > ?
+ORDER BY c.start_time
+LIMIT ?
+"""
+HISTORY_COLUMNS = [
+    'cycle_id', 'start', 'end', 'strain', 'kilojoule', 'average_heart_rate',
+    'max_heart_rate', 'recovery_score', 'resting_heart_rate', 'hrv_rmssd_milli',
+    'spo2_percentage', 'skin_temp_celsius', 'sleep_performance_percentage',
+    'respiratory_rate'
+]
+HISTORY_MAX_LIMIT = 1000
+
+def to_whoop_time(value):
+    """Format an ISO datetime the way Whoop timestamps are stored, for comparisons"""
+    parsed = datetime.fromisoformat(value)
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    parsed = parsed.astimezone(timezone.utc)
+    return parsed.strftime('%Y-%m-%dT%H:%M:%S.') + f"{parsed.microsecond // 1000:03d}Z"
+
+@bp.route('/history')
+@require_api_token
+def get_history():
+    """Page through per-cycle metrics with a start-time cursor"""
+    whoop_id = request.args.get('user_id', type=int)
+    if not whoop_id:
+        return jsonify({"error": "user_id parameter is required"}), 400
+
+    limit = max(1, min(request.args.get('limit', 200, type=int), HISTORY_MAX_LIMIT))
+    try:
+        after = to_whoop_time(request.args['after']) if request.args.get('after') else ''
+    except ValueError:
+        return jsonify({"error": "after must be an ISO datetime"}), 400
+
+    try:
+        conn = connect_user_db(whoop_id)
+        rows = []
+        if conn is not None:
+            with conn:
+                rows = conn.execute(HISTORY_QUERY, (whoop_id, after, limit)).fetchall()
+    except Exception as e:
+        logger.error(f"Error reading history: {e}")
+        return jsonify({"error": "Error reading history"}), 500
+
+    cycles = [dict(zip(HISTORY_COLUMNS, row)) for row in rows]
+    return jsonify({
+        "user_id": whoop_id,
+        "cycles": cycles,
+        # Pass back as `after` to get the next page
+        "next": cycles[-1]['start'] if len(cycles) == limit else None
+    })
+
+@bp.route('/user', methods=['DELETE'])
+@require_api_token
+def remove_user():
+    whoop_id = request.args.get('user_id', type=int)
+    if not whoop_id:
+        return jsonify({"error": "user_id parameter is required"}), 400
+
+    try:
+        delete_user(whoop_id)
+    except Exception as e:
+        logger.error(f"Error deleting user {whoop_id}: {e}")
+        return jsonify({"error": "Error deleting user"}), 500
+    return jsonify({"status": "deleted", "user_id": whoop_id})
+
+@bp.route('/refresh')
 @require_api_token
 def manual_refresh():
-    whoop_id = request.args.get('user_id')
+    whoop_id = request.args.get('user_id', type=int)
     if not whoop_id:
         return jsonify({"error": "user_id parameter is required"}), 400
 
-    data = get_whoop_data(whoop_id)
+    # Don't queue behind a dead upstream, answer from the last snapshot instead
+    data = None
+    if whoop_circuit.state != OPEN:
+        data = refresh_user_data(whoop_id)
     if data:
         return jsonify({"status": "success", "data": data})
-    return jsonify({"status": "error", "message": "Failed to refresh data"}), 500
 
-def get_whoop_data(whoop_id):
+    try:
+        snapshot = read_latest_snapshot(whoop_id)
+    except Exception as e:
+        logger.error(f"Error reading data: {e}")
+        snapshot = None
+    if snapshot:
+        return jsonify({
+            "status": "stale",
+            "message": "Upstream refresh unavailable, serving last stored data",
+            "retry_after": whoop_circuit.retry_after(),
+            "data": snapshot
+        })
+    return jsonify({"status": "error", "message": "Failed to refresh data"}), 503
+
+# Users with a refresh in flight, so concurrent refreshes don't pile up
+_refreshing = set()
+_refreshing_lock = threading.Lock()
+
+def refresh_user_data(whoop_id):
+    """Fetch fresh data for a user unless a refresh is already running.
+
+    Returns None immediately, without waiting, when another thread is already
+    refreshing the same user.
+    """
+    key = str(whoop_id)
+    with _refreshing_lock:
+        if key in _refreshing:
+            return None
+        _refreshing.add(key)
+    user_token = current_user.set(key)
+    try:
+        return get_whoop_data(whoop_id)
+    finally:
+        current_user.reset(user_token)
+        with _refreshing_lock:
+            _refreshing.discard(key)
+
+def whoop_request(method, url, **kwargs):
+    """Call the Whoop API through the circuit breaker with a timeout.
+
+    Connection errors, timeouts, 5xx and 429 responses count as upstream
+    failures. Raises CircuitOpenError without making a call while the
+    circuit is open.
+    """
+    if not whoop_circuit.allow_request():
+        raise CircuitOpenError("Whoop API circuit is open")
+    kwargs.setdefault('timeout', UPSTREAM_TIMEOUT)
+    try:
+        with profiler.phase('upstream'):
+            response = requests.request(method, url, **kwargs)
+    except requests.exceptions.RequestException:
+        whoop_circuit.record_failure()
+        raise
+    if response.status_code >= 500 or response.status_code == 429:
+        whoop_circuit.record_failure()
+    else:
+        whoop_circuit.record_success()
+    return response
+
+def read_json(response):
+    """Decode a Whoop API response body"""
+    with profiler.phase('json_parse'):
+        return response.json()
+
+def get_whoop_data(whoop_id, refresh_on_401=True):
     token_info = get_user_token(whoop_id)
     if not token_info:
         return None
@@ -268,76 +1281,157 @@ def get_whoop_data(whoop_id):
         # Get current cycle first
         current_cycle = get_current_cycle(headers)
         if not current_cycle:
-            # Try refreshing token if we got None (which might be due to 401)
-            new_token = refresh_token(whoop_id)
-            if new_token:
-                headers = {'Authorization': f"Bearer {new_token}"}
-                current_cycle = get_current_cycle(headers)
-                if not current_cycle:
-                    logger.error("No current cycle found even after token refresh")
-                    return None
-            else:
-                logger.error("Failed to refresh token")
-                return None
+            logger.error(f"No current cycle found for user {whoop_id}")
+            return None
 
         cycle_id = current_cycle['id']
         
         # Get data for the current cycle
         recovery_data = get_recovery_for_cycle(cycle_id, headers)
-        sleep_data = get_sleep_for_cycle(cycle_id, headers)
-        workout_data = get_workout_for_cycle(cycle_id, headers)
+        sleeps = get_sleeps_for_cycle(current_cycle, headers)
+        workouts = get_workouts_for_cycle(current_cycle, headers)
 
         data = {
             'timestamp': datetime.now(timezone.utc).isoformat(),
             'cycle': current_cycle,
             'recovery': recovery_data,
-            'sleep': sleep_data,
-            'workout': workout_data
+            'sleep': select_main_sleep(sleeps, recovery_data),
+            'workout': workouts[-1] if workouts else None,
+            'sleeps': sleeps or [],
+            'workouts': workouts or [],
+            'workout_summary': summarize_workouts(workouts)
         }
 
         save_whoop_data_to_db(whoop_id, data)
-        logger.info(f"Data fetched and saved successfully for user {whoop_id}")
+        logger.info(f"Data fetched for user {whoop_id}, snapshot queued for saving")
         return data
 
+    except CircuitOpenError:
+        logger.warning(f"Whoop API unavailable, skipping refresh for user {whoop_id}")
+        return None
     except requests.exceptions.HTTPError as e:
-        if e.response.status_code == 401:
+        # Only a real 401 rotates the refresh token, and only once per call
+        if e.response is not None and e.response.status_code == 401 and refresh_on_401:
             logger.warning("Token expired, attempting refresh")
             new_token = refresh_token(whoop_id)
             if new_token:
-                return get_whoop_data(whoop_id)  # Retry with new token
+                return get_whoop_data(whoop_id, refresh_on_401=False)  # Retry with new token
         logger.error(f"HTTP error fetching data: {e}")
         return None
     except Exception as e:
         logger.error(f"Error fetching data: {e}")
         return None
 
+def archive_old_cycles():
+    """Move closed cycles older than ARCHIVE_AFTER_DAYS into the cold archive.
+
+    A cycle is closed once a newer cycle has been recorded for the user. All
+    snapshots of a closed cycle are written to the user's monthly segments
+    and then deleted from whoop_data.
+    """
+    if ARCHIVE_AFTER_DAYS <= 0:
+        return 0
+
+    cutoff = (datetime.now(timezone.utc) - timedelta(days=ARCHIVE_AFTER_DAYS)).isoformat()
+    archived = 0
+    with connect_db() as conn:
+        users = conn.execute("SELECT whoop_id FROM users").fetchall()
+
+    for (whoop_id,) in users:
+        conn = connect_user_db(whoop_id)
+        if conn is None:
+            continue
+        with conn:
+            row_ids = [row[0] for row in conn.execute("""
+            SELECT id FROM whoop_data
+            WHERE whoop_id = ? AND cycle_id IN (
+                SELECT cycle_id FROM whoop_data
+                WHERE whoop_id = ?
+                GROUP BY cycle_id
+                HAVING MAX(timestamp) < ?
+            ) AND cycle_id != (
+                SELECT cycle_id FROM whoop_data
+                WHERE whoop_id = ?
+                ORDER BY timestamp DESC
+                LIMIT 1
+            )
+            ORDER BY id
+            """, (whoop_id, whoop_id, cutoff, whoop_id))]
+
+            for i in range(0, len(row_ids), EXPORT_BATCH_SIZE):
+                batch_ids = row_ids[i:i + EXPORT_BATCH_SIZE]
+                placeholders = ','.join('?' * len(batch_ids))
+                rows = conn.execute(f"""
+                SELECT {', '.join(archive.COLUMNS)} FROM whoop_data
+                WHERE id IN ({placeholders})
+                ORDER BY id
+                """, batch_ids).fetchall()
+
+                by_month = {}
+                for row in rows:
+                    by_month.setdefault(row[2][:7], []).append(row)
+                for month, month_rows in by_month.items():
+                    archive.append_rows(ARCHIVE_DIR, whoop_id, month, month_rows)
+
+                conn.execute(f"DELETE FROM whoop_data WHERE id IN ({placeholders})", batch_ids)
+                conn.commit()
+                archived += len(rows)
+
+    if archived:
+        logger.info(f"Archived {archived} snapshots older than {ARCHIVE_AFTER_DAYS} days")
+    return archived
+
 def background_data_refresh():
+    try:
+        backfill_pending_entities()
+    except Exception as e:
+        logger.error(f"Error backfilling entities: {e}")
+
+    last_archive = 0
     while True:
         try:
-            with sqlite3.connect(DB_PATH) as conn:
-                cursor = conn.execute("SELECT whoop_id FROM users")
-                users = cursor.fetchall()
-                
-            for user in users:
+            if time.time() - last_archive >= ARCHIVE_INTERVAL:
+                last_archive = time.time()
                 try:
-                    get_whoop_data(user[0])
+                    archive_old_cycles()
                 except Exception as e:
-                    logger.error(f"Error refreshing data for user {user[0]}: {e}")
-                    
+                    logger.error(f"Error archiving old cycles: {e}")
+
+            with profiler.operation('refresh_pass', full=profiler.should_profile()):
+                with connect_db() as conn:
+                    cursor = conn.execute("SELECT whoop_id FROM users")
+                    users = cursor.fetchall()
+
+                for user in users:
+                    # Leave the rest of the pass for later rather than failing every user
+                    if whoop_circuit.state == OPEN:
+                        logger.warning("Whoop API unavailable, postponing refresh pass")
+                        break
+                    try:
+                        refresh_user_data(user[0])
+                    except Exception as e:
+                        logger.error(f"Error refreshing data for user {user[0]}: {e}")
+
             time.sleep(300)  # Wait 5 minutes before next refresh
         except Exception as e:
             logger.error(f"Error in background refresh: {e}")
             time.sleep(60)  # Wait 1 minute on error before retrying
 
-# Start background refresh thread
-refresh_thread = threading.Thread(target=background_data_refresh, daemon=True)
-refresh_thread.start()
+_refresh_thread = None
 
-@app.route('/')
+def start_background_refresh():
+    """Start the background refresh thread once per process."""
+    global _refresh_thread
+    if _refresh_thread is None or not _refresh_thread.is_alive():
+        _refresh_thread = threading.Thread(target=background_data_refresh, daemon=True)
+        _refresh_thread.start()
+    return _refresh_thread
+
+@bp.route('/')
 def home():
     return 'Whoop Integration Service'
 
-@app.route('/auth')
+@bp.route('/auth')
 def auth():
     state = generate_state()
     session['oauth_state'] = state
@@ -350,12 +1444,13 @@ def get_user_profile(access_token):
         headers = {'Authorization': f"Bearer {access_token}"}
         
         # Get user profile
-        response = requests.get(
+        response = whoop_request(
+            'GET',
             f"{WHOOP_API_BASE}/user/profile/basic",
             headers=headers
         )
         response.raise_for_status()
-        user_data = response.json()
+        user_data = read_json(response)
         
         return {
             'id': user_data.get('user_id'),
@@ -367,7 +1462,7 @@ def get_user_profile(access_token):
         logger.error(f"Error getting user profile: {e}")
         return None
 
-@app.route('/login')
+@bp.route('/login')
 def login():
     code = request.args.get('code')
     state = request.args.get('state')
@@ -390,9 +1485,11 @@ def login():
 
     try:
         # Get token
-        response = requests.post(WHOOP_TOKEN_URL, data=token_data)
+        response = whoop_request(
+            'POST', WHOOP_TOKEN_URL, data=token_data, timeout=(UPSTREAM_TIMEOUT, TOKEN_TIMEOUT)
+        )
         response.raise_for_status()
-        token_info = response.json()
+        token_info = read_json(response)
         
         # Get user profile
         user_profile = get_user_profile(token_info['access_token'])
@@ -414,7 +1511,34 @@ def login():
         logger.error(f"Error during login: {e}")
         return 'An error occurred during login', 500
 
-@app.route('/webhook', methods=['POST'])
+@bp.route('/profile/summary')
+@require_api_token
+def profile_summary():
+    if not profiler.enabled:
+        return jsonify({"error": "Profiling is disabled, set PROFILE_MODE to enable it"}), 404
+    limit = request.args.get('limit', 20, type=int)
+    return jsonify({
+        "mode": profiler.mode,
+        "write_queue_depth": db_writer.depth(),
+        "operations": profiler.slowest(limit)
+    })
+
+def begin_request_profile():
+    """Start timing the request, fully profiling it if asked to and allowed."""
+    if not profiler.enabled:
+        return
+    # Only authenticated callers may ask for a full profile
+    requested = (
+        (request.args.get('profile') == '1' or request.headers.get('X-Profile') == '1')
+        and request.headers.get('X-API-Token') == API_TOKEN
+        and API_TOKEN is not None
+    )
+    profiler.begin(f"{request.method} {request.path}", full=profiler.should_profile(requested))
+
+def end_request_profile(exc=None):
+    profiler.end()
+
+@bp.route('/webhook', methods=['POST'])
 def webhook():
     data = request.json
     # TODO: Process webhook data
@@ -431,14 +1555,23 @@ def get_current_cycle(headers):
             'limit': 1,  # Get only the latest cycle
             'end': datetime.now(timezone.utc).isoformat()  # Up to current time
         }
-        response = requests.get(
+        response = whoop_request(
+            'GET',
             f"{WHOOP_API_BASE}/cycle",
             headers=headers,
             params=params
         )
         response.raise_for_status()
-        cycles = response.json().get('records', [])
+        cycles = read_json(response).get('records', [])
         return cycles[0] if cycles else None
+    except CircuitOpenError:
+        raise
+    except requests.exceptions.HTTPError as e:
+        # An expired token is handled by get_whoop_data()
+        if e.response is not None and e.response.status_code == 401:
+            raise
+        logger.error(f"Error getting current cycle: {e}")
+        return None
     except Exception as e:
         logger.error(f"Error getting current cycle: {e}")
         return None
@@ -446,115 +1579,185 @@ def get_current_cycle(headers):
 def get_recovery_for_cycle(cycle_id, headers):
     """Get recovery data for a specific cycle"""
     try:
-        response = requests.get(
+        response = whoop_request(
+            'GET',
             f"{WHOOP_API_BASE}/cycle/{cycle_id}/recovery",
             headers=headers
         )
         if response.status_code == 404:
             return None
         response.raise_for_status()
-        return response.json()
+        return read_json(response)
+    except CircuitOpenError:
+        raise
     except Exception as e:
         logger.error(f"Error getting recovery for cycle {cycle_id}: {e}")
         return None
 
-def get_sleep_for_cycle(cycle_id, headers):
-    """Get sleep data for a specific cycle"""
-    try:
-        # First get sleep collection to find the latest sleep
-        params = {
-            'limit': 1,
-            'end': datetime.now(timezone.utc).isoformat()
-        }
-        response = requests.get(
-            f"{WHOOP_API_BASE}/activity/sleep",
+def get_collection(path, headers, params):
+    """Get every record of a Whoop collection endpoint, following next_token pages"""
+    params = dict(params, limit=25)  # Maximum page size allowed by Whoop
+    records = []
+    while True:
+        response = whoop_request(
+            'GET',
+            f"{WHOOP_API_BASE}/{path}",
             headers=headers,
             params=params
         )
         response.raise_for_status()
-        sleeps = response.json().get('records', [])
-        if not sleeps:
-            return None
-            
-        # Get detailed sleep data
-        sleep_id = sleeps[0]['id']
-        sleep_response = requests.get(
-            f"{WHOOP_API_BASE}/activity/sleep/{sleep_id}",
-            headers=headers
-        )
-        sleep_response.raise_for_status()
-        return sleep_response.json()
+        page = read_json(response)
+        records.extend(page.get('records', []))
+        if not page.get('next_token'):
+            return records
+        params['nextToken'] = page['next_token']
+
+def cycle_window(cycle):
+    """Collection query bounds covering a cycle, open-ended for the current one"""
+    return {
+        'start': cycle['start'],
+        'end': cycle.get('end') or datetime.now(timezone.utc).isoformat()
+    }
+
+def get_sleeps_for_cycle(cycle, headers):
+    """Get all sleeps and naps that started within a cycle, oldest first"""
+    try:
+        sleeps = get_collection('activity/sleep', headers, cycle_window(cycle))
+        return sorted(sleeps, key=lambda sleep: sleep['start'])
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        logger.error(f"Error getting sleep data: {e}")
+        logger.error(f"Error getting sleep data for cycle {cycle['id']}: {e}")
         return None
 
-def get_workout_for_cycle(cycle_id, headers):
-    """Get workout data for a specific cycle"""
+def get_workouts_for_cycle(cycle, headers):
+    """Get all workouts that started within a cycle, oldest first"""
     try:
-        # First get workout collection to find the latest workout
-        params = {
-            'limit': 1,
-            'end': datetime.now(timezone.utc).isoformat()
-        }
-        response = requests.get(
-            f"{WHOOP_API_BASE}/activity/workout",
-            headers=headers,
-            params=params
-        )
-        response.raise_for_status()
-        workouts = response.json().get('records', [])
-        if not workouts:
-            return None
-            
-        # Get detailed workout data
-        workout_id = workouts[0]['id']
-        workout_response = requests.get(
-            f"{WHOOP_API_BASE}/activity/workout/{workout_id}",
-            headers=headers
-        )
-        workout_response.raise_for_status()
-        return workout_response.json()
+        workouts = get_collection('activity/workout', headers, cycle_window(cycle))
+        return sorted(workouts, key=lambda workout: workout['start'])
+    except CircuitOpenError:
+        raise
     except Exception as e:
-        logger.error(f"Error getting workout data: {e}")
+        logger.error(f"Error getting workout data for cycle {cycle['id']}: {e}")
         return None
 
+def select_main_sleep(sleeps, recovery):
+    """Pick the sleep a cycle's recovery was scored from, else the latest non-nap"""
+    if not sleeps:
+        return None
+    sleep_id = recovery.get('sleep_id') if recovery else None
+    for sleep in sleeps:
+        if sleep['id'] == sleep_id:
+            return sleep
+    main_sleeps = [sleep for sleep in sleeps if not sleep.get('nap')]
+    return (main_sleeps or sleeps)[-1]
+
+def summarize_workouts(workouts):
+    """Aggregate a cycle's workouts into daily totals"""
+    summary = {
+        'workout_count': 0,
+        'total_duration_milli': 0,
+        'total_kilojoule': 0.0,
+        'total_distance_meter': 0.0,
+        'max_strain': None,
+        'zone_duration': {}
+    }
+    for workout in workouts or []:
+        summary['workout_count'] += 1
+        if workout.get('start') and workout.get('end'):
+            duration = datetime.fromisoformat(workout['end']) - datetime.fromisoformat(workout['start'])
+            summary['total_duration_milli'] += int(duration.total_seconds() * 1000)
+        score = workout.get('score') or {}
+        summary['total_kilojoule'] += score.get('kilojoule') or 0
+        summary['total_distance_meter'] += score.get('distance_meter') or 0
+        if score.get('strain') is not None:
+            summary['max_strain'] = max(summary['max_strain'] or 0, score['strain'])
+        for zone, milli in (score.get('zone_duration') or {}).items():
+            summary['zone_duration'][zone] = summary['zone_duration'].get(zone, 0) + (milli or 0)
+    return summary
+
+def write_tokens(conn, whoop_id, token_info):
+    expires_at = datetime.now(timezone.utc) + timedelta(seconds=token_info['expires_in'])
+    conn.execute(
+        """
+        UPDATE tokens 
+        SET access_token = ?, refresh_token = ?, expires_at = ?
+        WHERE whoop_id = ?
+        """,
+        (token_info['access_token'], token_info['refresh_token'], expires_at, whoop_id)
+    )
+
+# Seconds refresh_token() waits for its token write before moving on
+TOKEN_WRITE_WAIT = 30
+
 def refresh_token(whoop_id):
     """Refresh the access token using the refresh token."""
     try:
-        with sqlite3.connect(DB_PATH) as conn:
+        with connect_db() as conn:
             cursor = conn.execute(
                 "SELECT refresh_token FROM tokens WHERE whoop_id = ?", (whoop_id,)
             )
             refresh_token = cursor.fetchone()
-            if not refresh_token:
-                return None
-
-            token_data = {
-                'client_id': WHOOP_CLIENT_ID,
-                'client_secret': WHOOP_CLIENT_SECRET,
-                'refresh_token': refresh_token[0],
-                'grant_type': 'refresh_token'
-            }
-
-            response = requests.post(WHOOP_TOKEN_URL, data=token_data)
-            response.raise_for_status()
-            token_info = response.json()
-
-            # Update tokens in database
-            expires_at = datetime.now(timezone.utc) + timedelta(seconds=token_info['expires_in'])
-            conn.execute(
-                """
-                UPDATE tokens 
-                SET access_token = ?, refresh_token = ?, expires_at = ?
-                WHERE whoop_id = ?
-                """,
-                (token_info['access_token'], token_info['refresh_token'], expires_at, whoop_id)
-            )
-            conn.commit()
-            return token_info['access_token']
+        if not refresh_token:
+            return None
+
+        token_data = {
+            'client_id': WHOOP_CLIENT_ID,
+            'client_secret': WHOOP_CLIENT_SECRET,
+            'refresh_token': refresh_token[0],
+            'grant_type': 'refresh_token'
+        }
+
+        response = whoop_request(
+            'POST', WHOOP_TOKEN_URL, data=token_data, timeout=(UPSTREAM_TIMEOUT, TOKEN_TIMEOUT)
+        )
+        response.raise_for_status()
+        token_info = read_json(response)
+
+        # Whoop has already rotated the refresh token, so this write is
+        # retried until it lands. Wait for it so the next read sees it.
+        with profiler.phase('db_write'):
+            future = db_writer.submit(DB_PATH, write_tokens, whoop_id, token_info, must_land=True)
+            try:
+                future.result(timeout=TOKEN_WRITE_WAIT)
+            except FutureTimeoutError:
+                logger.warning(f"Token write for user {whoop_id} is still being retried")
+        return token_info['access_token']
+    except CircuitOpenError:
+        raise
+    except requests.exceptions.ReadTimeout:
+        # The request was sent, so Whoop may have rotated the refresh token
+        # without us ever seeing the new one
+        logger.error(
+            f"No response to token refresh for user {whoop_id} after {TOKEN_TIMEOUT}s, "
+            "the user may need to log in again"
+        )
+        return None
     except Exception as e:
         logger.error(f"Error refreshing token: {e}")
         return None
 
+def create_app(start_scheduler=True):
+    """Build the Flask app.
+
+    Loads the .env file and configures logging. The database schema is
+    created lazily on first use. Pass start_scheduler=False to leave
+    starting the background refresh to the caller, e.g. a gunicorn post_fork
+    hook when the app is preloaded.
+    """
+    load_dotenv(os.path.join(os.getenv('CONFIG_DIR', './config'), '.env'))
+    load_settings()
+    configure_logging()
+
+    app = Flask(__name__)
+    app.secret_key = FLASK_SECRET_KEY
+    app.register_blueprint(bp)
+    app.before_request(begin_request_profile)
+    app.teardown_request(end_request_profile)
+
+    if start_scheduler:
+        start_background_refresh()
+    return app
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=2008) 
\ No newline at end of file
+    create_app().run(host='0.0.0.0', port=2008)
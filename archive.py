@@ -0,0 +1,191 @@
+"""Cold archive tier for old Whoop snapshots.
+
+Closed cycles older than the retention window are moved out of the hot
+``whoop_data`` table into append-only segment files, one pair per user and
+month:
+
+    <archive_dir>/<whoop_id>/<YYYY-MM>.seg  zlib-compressed JSON records
+    <archive_dir>/<whoop_id>/<YYYY-MM>.idx  fixed-size index entries
+
+Each index entry holds the original row id, the snapshot time as a unix
+timestamp and the record's offset and length in the segment. Readers map both
+files with mmap and only decompress the records inside the requested range.
+"""
+import fcntl
+import json
+import mmap
+import os
+import struct
+import zlib
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime
+
+# Column order of the whoop_data table, used for every archived record
+COLUMNS = (
+    'id', 'whoop_id', 'timestamp', 'cycle_id', 'cycle_data', 'recovery_data',
+    'sleep_data', 'workout_data', 'recovery_score', 'sleep_score',
+    'strain_score', 'calories_burned', 'average_heart_rate', 'max_heart_rate',
+    'respiratory_rate', 'spo2_percentage', 'skin_temp_celsius'
+)
+
+# row id, unix timestamp, segment offset, record length
+INDEX_ENTRY = struct.Struct('<qdQI')
+
+
+def _paths(archive_dir, whoop_id, month):
+    base = os.path.join(archive_dir, str(whoop_id), month)
+    return base + '.seg', base + '.idx'
+
+
+def _to_epoch(timestamp):
+    return datetime.fromisoformat(timestamp).timestamp()
+
+
+def _map(path):
+    """Map a file read-only, or return None if it is missing or empty."""
+    try:
+        with open(path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return None
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _user_lock(archive_dir, whoop_id):
+    """Hold an exclusive lock on a user's archive across processes."""
+    user_dir = os.path.join(archive_dir, str(whoop_id))
+    os.makedirs(user_dir, exist_ok=True)
+    with open(os.path.join(user_dir, '.lock'), 'a') as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_UN)
+
+
+class _IndexTimestamps:
+    """Sequence view of the timestamps in a mapped index, for bisecting."""
+
+    def __init__(self, index):
+        self._index = index
+
+    def __len__(self):
+        return len(self._index) // INDEX_ENTRY.size
+
+    def __getitem__(self, i):
+        return INDEX_ENTRY.unpack_from(self._index, i * INDEX_ENTRY.size)[1]
+
+
+def last_archived_id(archive_dir, whoop_id, month):
+    """Return the highest row id already stored in a month's segment."""
+    _, idx_path = _paths(archive_dir, whoop_id, month)
+    try:
+        with open(idx_path, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            usable = size - size % INDEX_ENTRY.size
+            if usable == 0:
+                return 0
+            f.seek(usable - INDEX_ENTRY.size)
+            return INDEX_ENTRY.unpack(f.read(INDEX_ENTRY.size))[0]
+    except FileNotFoundError:
+        return 0
+
+
+def append_rows(archive_dir, whoop_id, month, rows):
+    """Append whoop_data rows (in id order) to a user's month segment.
+
+    Rows that are already in the segment are skipped, so a job interrupted
+    between writing the archive and deleting the hot rows can simply run
+    again. The segment is synced before the index so an index entry never
+    points at data that was not written. Appends hold a per-user file lock,
+    so workers archiving the same user at once don't write rows twice.
+    """
+    with _user_lock(archive_dir, whoop_id):
+        return _append_rows(archive_dir, whoop_id, month, rows)
+
+
+def _append_rows(archive_dir, whoop_id, month, rows):
+    last_id = last_archived_id(archive_dir, whoop_id, month)
+    rows = [row for row in rows if row[0] > last_id]
+    if not rows:
+        return 0
+
+    seg_path, idx_path = _paths(archive_dir, whoop_id, month)
+    os.makedirs(os.path.dirname(seg_path), exist_ok=True)
+
+    entries = []
+    with open(seg_path, 'ab') as seg:
+        offset = seg.tell()
+        for row in rows:
+            record = zlib.compress(json.dumps(row).encode('utf-8'))
+            seg.write(record)
+            entries.append(INDEX_ENTRY.pack(row[0], _to_epoch(row[2]), offset, len(record)))
+            offset += len(record)
+        seg.flush()
+        os.fsync(seg.fileno())
+
+    with open(idx_path, 'ab') as idx:
+        # Drop a torn entry left behind by an interrupted append
+        size = idx.tell()
+        if size % INDEX_ENTRY.size:
+            idx.truncate(size - size % INDEX_ENTRY.size)
+        idx.write(b''.join(entries))
+        idx.flush()
+        os.fsync(idx.fileno())
+
+    return len(rows)
+
+
+def list_months(archive_dir, whoop_id):
+    """Return the archived months for a user, oldest first."""
+    try:
+        names = os.listdir(os.path.join(archive_dir, str(whoop_id)))
+    except FileNotFoundError:
+        return []
+    return sorted(name[:-4] for name in names if name.endswith('.idx'))
+
+
+def iter_month(archive_dir, whoop_id, month, start=None, end=None):
+    """Yield archived rows for one month with start <= time < end.
+
+    ``start`` and ``end`` are unix timestamps. Only the index entries and
+    records inside the range are touched.
+    """
+    seg_path, idx_path = _paths(archive_dir, whoop_id, month)
+    index = _map(idx_path)
+    if index is None:
+        return
+    segment = _map(seg_path)
+    try:
+        if segment is None:
+            return
+        timestamps = _IndexTimestamps(index)
+        i = bisect_left(timestamps, start) if start is not None else 0
+        for i in range(i, len(timestamps)):
+            _, ts, offset, length = INDEX_ENTRY.unpack_from(index, i * INDEX_ENTRY.size)
+            if end is not None and ts >= end:
+                break
+            yield json.loads(zlib.decompress(segment[offset:offset + length]))
+    finally:
+        index.close()
+        if segment is not None:
+            segment.close()
+
+
+def iter_rows(archive_dir, whoop_id, date_from=None, date_to=None):
+    """Yield archived rows for a user across months in time order.
+
+    ``date_from`` and ``date_to`` are ISO timestamps, as used by the hot
+    table queries.
+    """
+    start = _to_epoch(date_from) if date_from else None
+    end = _to_epoch(date_to) if date_to else None
+    for month in list_months(archive_dir, whoop_id):
+        if date_from and month < date_from[:7]:
+            continue
+        if date_to and month > date_to[:7]:
+            break
+        yield from iter_month(archive_dir, whoop_id, month, start, end)
@@ -0,0 +1,79 @@
+"""Circuit breaker for calls to the Whoop API.
+
+After ``failure_threshold`` consecutive failures the circuit opens and calls
+are rejected without touching the network. Once ``reset_timeout`` seconds
+have passed it goes half-open and lets a limited number of probe calls
+through: a successful probe closes the circuit again, a failed one reopens
+it for another ``reset_timeout``.
+"""
+import math
+import threading
+import time
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class CircuitOpenError(Exception):
+    """Raised when a call is rejected because the circuit is open."""
+
+
+class CircuitBreaker:
+    """Thread-safe consecutive-failure circuit breaker."""
+
+    def __init__(self, failure_threshold=5, reset_timeout=60, half_open_max_calls=1):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.half_open_max_calls = half_open_max_calls
+        self._state = CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probes = 0
+        self.last_failure = None
+        self.last_success = None
+        self._lock = threading.Lock()
+
+    def _refresh_state(self):
+        if self._state == OPEN and time.monotonic() - self._opened_at >= self.reset_timeout:
+            self._state = HALF_OPEN
+            self._probes = 0
+
+    @property
+    def state(self):
+        with self._lock:
+            self._refresh_state()
+            return self._state
+
+    def allow_request(self):
+        """Return True if a call may go out now, reserving a probe slot if half-open."""
+        with self._lock:
+            self._refresh_state()
+            if self._state == CLOSED:
+                return True
+            if self._state == HALF_OPEN and self._probes < self.half_open_max_calls:
+                self._probes += 1
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self._state = CLOSED
+            self._failures = 0
+            self.last_success = time.time()
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self.last_failure = time.time()
+            if self._state == HALF_OPEN or self._failures >= self.failure_threshold:
+                self._state = OPEN
+                self._opened_at = time.monotonic()
+
+    def retry_after(self):
+        """Seconds until the next probe is allowed, 0 if calls may go out."""
+        with self._lock:
+            self._refresh_state()
+            if self._state != OPEN:
+                return 0
+            return max(0, math.ceil(self.reset_timeout - (time.monotonic() - self._opened_at)))
@@ -16,13 +16,31 @@ from homeassistant.helpers.update_coordinator import (
     DataUpdateCoordinator,
 )
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
+from homeassistant.helpers.event import async_track_time_interval
+
+from .statistics import async_import_statistics
 
 _LOGGER = logging.getLogger(__name__)
 
 DOMAIN = "whoop"
 SCAN_INTERVAL = timedelta(minutes=5)
+STATISTICS_INTERVAL = timedelta(hours=1)
 ATTRIBUTION = "Data provided by Whoop Integration"
 
+# Parts of the /data payload the sensors read
+DATA_FIELDS = ",".join([
+    "cycle.id", "cycle.start", "cycle.end", "cycle.timezone_offset", "cycle.score_state",
+    "cycle.score.strain", "cycle.score.kilojoule",
+    "cycle.score.average_heart_rate", "cycle.score.max_heart_rate",
+    "recovery.cycle_id", "recovery.sleep_id", "recovery.created_at",
+    "recovery.updated_at", "recovery.score",
+    "sleep.start", "sleep.end", "sleep.score",
+    "workout.id", "workout.sport_id", "workout.start", "workout.end", "workout.score",
+    "workout_summary",
+    "analytics.illness_risk", "analytics.overtraining_risk",
+    "analytics.metrics.*.z_score", "analytics.metrics.*.anomaly",
+])
+
 WHOOP_API_URL = None # Will be set during setup
 API_TOKEN = None # Will be set during setup
 
@@ -47,6 +65,22 @@ async def async_setup_entry(
 
     async_add_entities(sensors, True)
 
+    async def _async_import_statistics(now=None) -> None:
+        """Push new history into long-term statistics."""
+        try:
+            await async_import_statistics(
+                hass, coordinator._session, WHOOP_API_URL, API_TOKEN, user_id
+            )
+        except Exception as err:
+            _LOGGER.error("Error importing Whoop statistics: %s", err)
+
+    config_entry.async_create_background_task(
+        hass, _async_import_statistics(), "whoop_statistics_import"
+    )
+    config_entry.async_on_unload(
+        async_track_time_interval(hass, _async_import_statistics, STATISTICS_INTERVAL)
+    )
+
 class WhoopDataUpdateCoordinator(DataUpdateCoordinator):
     """Class to manage fetching Whoop data."""
 
@@ -63,18 +97,22 @@ class WhoopDataUpdateCoordinator(DataUpdateCoordinator):
         self._session = async_get_clientsession(hass)
 
     async def _async_update_data(self):
-        """Fetch data from Whoop API."""
+        """Fetch the sections that changed since the last update and merge them in."""
         try:
             headers = {"X-API-Token": API_TOKEN}
+            params = {"user_id": self.user_id, "fields": DATA_FIELDS}
+            if self.data and self.data.get("version"):
+                params["since"] = self.data["version"]
             async with self._session.get(
-                f"{WHOOP_API_URL}/data?user_id={self.user_id}",
+                f"{WHOOP_API_URL}/data",
                 headers=headers,
+                params=params,
                 timeout=10,
             ) as response:
                 response.raise_for_status()
-                data = await response.json()
+                changes = await response.json()
                 self._last_update = datetime.now()
-                return data
+                return {**(self.data or {}), **changes}
         except Exception as err:
             _LOGGER.error("Error fetching Whoop data: %s", err)
             raise
@@ -140,6 +178,19 @@ class WhoopRecoverySensor(WhoopSensor):
                     "cycle_id": self.coordinator.data["recovery"].get("cycle_id"),
                     "sleep_id": self.coordinator.data["recovery"].get("sleep_id"),
                 })
+            if self.coordinator.data and self.coordinator.data.get("analytics"):
+                trends = self.coordinator.data["analytics"]
+                metrics = trends.get("metrics", {})
+                attrs.update({
+                    "hrv_zscore": metrics.get("hrv_rmssd_milli", {}).get("z_score"),
+                    "resting_heart_rate_zscore": metrics.get("resting_heart_rate", {}).get("z_score"),
+                    "respiratory_rate_zscore": metrics.get("respiratory_rate", {}).get("z_score"),
+                    "skin_temp_zscore": metrics.get("skin_temp_celsius", {}).get("z_score"),
+                    "spo2_zscore": metrics.get("spo2_percentage", {}).get("z_score"),
+                    "anomalies": [name for name, metric in metrics.items() if metric.get("anomaly")],
+                    "illness_risk": trends.get("illness_risk"),
+                    "overtraining_risk": trends.get("overtraining_risk"),
+                })
         except Exception as err:
             _LOGGER.error("Error getting recovery attributes: %s", err)
         return attrs
@@ -147,6 +198,23 @@ class WhoopRecoverySensor(WhoopSensor):
 class WhoopSleepSensor(WhoopSensor):
     """Implementation of a Whoop Sleep sensor."""
 
+    # Detail attributes change every night; keep them out of the recorder
+    _unrecorded_attributes = frozenset({
+        "sleep_cycles",
+        "disturbances",
+        "total_sleep_time",
+        "light_sleep_time",
+        "rem_sleep_time",
+        "deep_sleep_time",
+        "awake_time",
+        "start_time",
+        "end_time",
+        "baseline_sleep_need",
+        "need_from_nap",
+        "need_from_strain",
+        "need_from_debt",
+    })
+
     @property
     def name(self) -> str:
         """Return the name of the sensor."""
@@ -293,6 +361,22 @@ class WhoopHeartRateSensor(WhoopSensor):
 class WhoopWorkoutSensor(WhoopSensor):
     """Implementation of a Whoop Workout sensor."""
 
+    # Heart rate zone breakdowns are large and not useful as state history
+    _unrecorded_attributes = frozenset({
+        "zone_duration_five",
+        "zone_duration_four",
+        "zone_duration_three",
+        "zone_duration_two",
+        "zone_duration_one",
+        "zone_duration_zero",
+        "daily_zone_duration_five",
+        "daily_zone_duration_four",
+        "daily_zone_duration_three",
+        "daily_zone_duration_two",
+        "daily_zone_duration_one",
+        "daily_zone_duration_zero",
+    })
+
     @property
     def name(self) -> str:
         """Return the name of the sensor."""
@@ -340,6 +424,22 @@ class WhoopWorkoutSensor(WhoopSensor):
                     "sport_id": self.coordinator.data["workout"].get("sport_id"),
                     "workout_id": self.coordinator.data["workout"].get("id"),
                 })
+            if self.coordinator.data and self.coordinator.data.get("workout_summary"):
+                summary = self.coordinator.data["workout_summary"]
+                zones = summary.get("zone_duration", {})
+                attrs.update({
+                    "daily_workout_count": summary.get("workout_count"),
+                    "daily_duration": summary.get("total_duration_milli"),
+                    "daily_kilojoules": summary.get("total_kilojoule"),
+                    "daily_distance": summary.get("total_distance_meter"),
+                    "daily_max_strain": summary.get("max_strain"),
+                    "daily_zone_duration_five": zones.get("zone_five_milli"),
+                    "daily_zone_duration_four": zones.get("zone_four_milli"),
+                    "daily_zone_duration_three": zones.get("zone_three_milli"),
+                    "daily_zone_duration_two": zones.get("zone_two_milli"),
+                    "daily_zone_duration_one": zones.get("zone_one_milli"),
+                    "daily_zone_duration_zero": zones.get("zone_zero_milli"),
+                })
         except Exception as err:
             _LOGGER.error("Error getting workout attributes: %s", err)
         return attrs
\ No newline at end of file
@@ -0,0 +1,117 @@
+"""Import Whoop history into Home Assistant long-term statistics."""
+from datetime import timedelta
+import logging
+
+from homeassistant.components.recorder import get_instance
+from homeassistant.components.recorder.models import StatisticData, StatisticMetaData
+from homeassistant.components.recorder.statistics import (
+    async_add_external_statistics,
+    get_last_statistics,
+)
+from homeassistant.const import PERCENTAGE, UnitOfEnergy, UnitOfTemperature
+from homeassistant.core import HomeAssistant
+from homeassistant.util import dt as dt_util
+
+_LOGGER = logging.getLogger(__name__)
+
+DOMAIN = "whoop"
+PAGE_SIZE = 500
+
+# Cycles are re-imported this far back on every run, since the current
+# cycle's strain and recovery keep changing until it closes
+REIMPORT_WINDOW = timedelta(days=2)
+
+# History field -> (statistic name, unit)
+STATISTICS = {
+    "recovery_score": ("Whoop Recovery Score", PERCENTAGE),
+    "resting_heart_rate": ("Whoop Resting Heart Rate", "bpm"),
+    "hrv_rmssd_milli": ("Whoop HRV (RMSSD)", "ms"),
+    "spo2_percentage": ("Whoop SpO2", PERCENTAGE),
+    "skin_temp_celsius": ("Whoop Skin Temperature", UnitOfTemperature.CELSIUS),
+    "strain": ("Whoop Day Strain", None),
+    "kilojoule": ("Whoop Day Energy", UnitOfEnergy.KILO_JOULE),
+    "average_heart_rate": ("Whoop Day Average Heart Rate", "bpm"),
+    "max_heart_rate": ("Whoop Day Max Heart Rate", "bpm"),
+    "sleep_performance_percentage": ("Whoop Sleep Performance", PERCENTAGE),
+    "respiratory_rate": ("Whoop Respiratory Rate", "rpm"),
+}
+
+
+def statistic_id(field: str, user_id: str) -> str:
+    """Return the external statistic id for a field of a user's history."""
+    return f"{DOMAIN}:{field}_{user_id}".lower()
+
+
+async def _async_last_imported(hass: HomeAssistant, user_id: str):
+    """Return the start of the newest imported statistic, or None."""
+    stat_ids = {statistic_id(field, user_id) for field in STATISTICS}
+    latest = None
+    for stat_id in stat_ids:
+        last = await get_instance(hass).async_add_executor_job(
+            get_last_statistics, hass, 1, stat_id, True, {"mean"}
+        )
+        if last.get(stat_id):
+            start = last[stat_id][0]["start"]
+            latest = start if latest is None else max(latest, start)
+    return dt_util.utc_from_timestamp(latest) if latest is not None else None
+
+
+def _add_page(hass: HomeAssistant, user_id: str, cycles: list[dict]) -> None:
+    """Queue one batch of statistics per field for a page of cycles."""
+    for field, (name, unit) in STATISTICS.items():
+        points = []
+        for cycle in cycles:
+            value = cycle.get(field)
+            if value is None or not cycle.get("start"):
+                continue
+            start = dt_util.parse_datetime(cycle["start"]).replace(
+                minute=0, second=0, microsecond=0
+            )
+            points.append(StatisticData(start=start, mean=value, min=value, max=value))
+        if not points:
+            continue
+        metadata = StatisticMetaData(
+            has_mean=True,
+            has_sum=False,
+            name=name,
+            source=DOMAIN,
+            statistic_id=statistic_id(field, user_id),
+            unit_of_measurement=unit,
+        )
+        async_add_external_statistics(hass, metadata, points)
+
+
+async def async_import_statistics(
+    hass: HomeAssistant, session, api_url: str, api_token: str, user_id: str
+) -> int:
+    """Import history that is not yet in the recorder, page by page.
+
+    The first run imports everything the server has. Later runs resume from
+    the newest imported statistic. Returns the number of cycles imported.
+    """
+    last = await _async_last_imported(hass, user_id)
+    after = (last - REIMPORT_WINDOW).isoformat() if last else None
+
+    imported = 0
+    headers = {"X-API-Token": api_token}
+    while True:
+        params = {"user_id": user_id, "limit": PAGE_SIZE}
+        if after:
+            params["after"] = after
+        async with session.get(
+            f"{api_url}/history", headers=headers, params=params, timeout=30
+        ) as response:
+            response.raise_for_status()
+            page = await response.json()
+
+        cycles = page.get("cycles", [])
+        if cycles:
+            _add_page(hass, user_id, cycles)
+            imported += len(cycles)
+        after = page.get("next")
+        if not after:
+            break
+
+    if imported:
+        _LOGGER.debug("Imported %s Whoop cycles into statistics", imported)
+    return imported
@@ -0,0 +1,263 @@
+"""Writer threads that group-commit SQLite writes.
+
+Callers hand a write function and the database file it targets to
+``BatchWriter.submit`` and get a ``concurrent.futures.Future`` back straight
+away. Each file is served by one lane: a thread that waits up to
+``max_delay`` seconds after the first pending write for more to arrive (or
+until ``max_batch`` are pending), then runs everything queued for the same
+file inside one transaction, so a burst of refreshes costs one commit per
+file instead of one per snapshot.
+
+Files are spread over ``workers`` lanes by path, and files listed in
+``dedicated`` get a lane of their own, so a busy shard only holds up the
+files that share its lane. Writes to one file always run in order.
+
+Each write runs under its own savepoint: one that raises is rolled back and
+its future gets the exception, while the rest of the batch still commits.
+A transaction that fails because the file is locked is retried with
+backoff. Writes submitted with ``must_land`` keep waiting out a lock until
+they commit; any other error fails every write in the transaction. Futures
+resolve only after the commit.
+
+Each lane queues at most ``max_queue`` writes. When a lane is that far
+behind, further writes to it fail straight away with ``WriterBacklogError``
+rather than piling up in memory.
+"""
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from concurrent.futures import Future
+
+_STOP = object()
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class WriterBacklogError(Exception):
+    """Raised through a future when its lane's queue is full."""
+
+
+def is_busy(error):
+    """Return True for errors that mean another connection holds the file."""
+    if not isinstance(error, sqlite3.OperationalError):
+        return False
+    message = str(error)
+    return 'locked' in message or 'busy' in message
+
+
+class _Lane:
+    def __init__(self, name):
+        self.name = name
+        self.queue = None
+        self.thread = None
+        self.connections = OrderedDict()  # path -> [connection, last used]
+
+
+class BatchWriter:
+    """Serializes writes per file onto a few threads and commits them in groups."""
+
+    def __init__(self, max_batch=100, max_delay=0.005, timeout=5, workers=4, dedicated=(),
+                 max_connections=64, idle_timeout=60, retries=5, max_backoff=2.0,
+                 max_queue=10000, observe=None, logger=None):
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.workers = workers
+        self.dedicated = set(dedicated)
+        self.max_connections = max_connections  # Per lane
+        self.idle_timeout = idle_timeout
+        self.retries = retries
+        self.max_backoff = max_backoff
+        self.max_queue = max_queue  # Per lane
+        self.logger = logger or _LOGGER
+        # Optional callable(path, count) returning a context manager that
+        # wraps each batch commit, e.g. to time it
+        self.observe = observe
+        self._lanes = {}
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, path, func, *args, must_land=False):
+        """Queue ``func(conn, *args)`` to run against the database at ``path``.
+
+        ``func`` must not commit. Returns a future for its return value.
+        """
+        future = Future()
+        lane = self._lane(path)
+        try:
+            lane.queue.put((path, func, args, future, must_land), timeout=self.timeout)
+        except queue.Full:
+            self.logger.error(f"Writer for {path} has {lane.queue.qsize()} writes queued, rejecting more")
+            future.set_exception(WriterBacklogError(f"Writer for {path} is backed up"))
+        return future
+
+    def depth(self):
+        """Return the number of queued writes per lane."""
+        with self._lock:
+            lanes = list(self._lanes.values()) if self._pid == os.getpid() else []
+        return {str(lane.name): lane.queue.qsize() for lane in lanes}
+
+    def release(self, path):
+        """Close the writer's connection to ``path`` once queued writes to it are done.
+
+        Call (and wait on the result) before removing the file.
+        """
+        return self.submit(path, None)
+
+    def stop(self):
+        """Flush pending writes and stop the writer threads."""
+        with self._lock:
+            lanes = list(self._lanes.values()) if self._pid == os.getpid() else []
+            for lane in lanes:
+                lane.queue.put(_STOP)
+            self._lanes = {}
+        for lane in lanes:
+            lane.thread.join()
+
+    def _lane(self, path):
+        if path in self.dedicated:
+            name = path
+        else:
+            name = zlib.crc32(path.encode()) % self.workers
+        with self._lock:
+            if self._pid != os.getpid():
+                # Forked child: the parent's threads, queues and connections
+                # did not come along
+                self._lanes = {}
+                self._pid = os.getpid()
+            lane = self._lanes.get(name)
+            if lane is None:
+                lane = self._lanes[name] = _Lane(name)
+                lane.queue = queue.Queue(self.max_queue)
+                lane.thread = threading.Thread(
+                    target=self._run, args=(lane,), name=f'db-writer-{name}', daemon=True
+                )
+                lane.thread.start()
+            return lane
+
+    def _run(self, lane):
+        stopping = False
+        while not stopping:
+            try:
+                batch = [lane.queue.get(timeout=self.idle_timeout)]
+            except queue.Empty:
+                self._close_idle(lane)
+                continue
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(lane.queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+
+            if _STOP in batch:
+                stopping = True
+                batch = [job for job in batch if job is not _STOP]
+
+            by_path = {}
+            for job in batch:
+                by_path.setdefault(job[0], []).append(job)
+            for path, jobs in by_path.items():
+                self._commit(lane, path, jobs)
+            self._close_idle(lane)
+
+        for path in list(lane.connections):
+            self._drop(lane, path)
+
+    def _connection(self, lane, path):
+        entry = lane.connections.get(path)
+        if entry is None:
+            conn = sqlite3.connect(path, timeout=self.timeout, isolation_level=None)
+            entry = lane.connections[path] = [conn, 0.0]
+            while len(lane.connections) > self.max_connections:
+                self._drop(lane, next(iter(lane.connections)))
+        lane.connections.move_to_end(path)
+        entry[1] = time.monotonic()
+        return entry[0]
+
+    def _close_idle(self, lane):
+        cutoff = time.monotonic() - self.idle_timeout
+        # Least recently used first, so stop at the first one still in use
+        for path, (_, last_used) in list(lane.connections.items()):
+            if last_used > cutoff:
+                break
+            self._drop(lane, path)
+
+    def _drop(self, lane, path):
+        entry = lane.connections.pop(path, None)
+        if entry is not None:
+            entry[0].close()
+
+    def _transaction(self, lane, path, writes):
+        conn = self._connection(lane, path)
+        results = []
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            for _, func, args, future, _ in writes:
+                conn.execute("SAVEPOINT job")
+                try:
+                    result = func(conn, *args)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO job")
+                    conn.execute("RELEASE job")
+                    results.append((future, None, e))
+                else:
+                    conn.execute("RELEASE job")
+                    results.append((future, result, None))
+            conn.execute("COMMIT")
+        except BaseException:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        return results
+
+    def _commit(self, lane, path, jobs):
+        writes = [job for job in jobs if job[1] is not None]
+        attempt = 0
+        while writes:
+            try:
+                if self.observe is not None:
+                    with self.observe(path, len(writes)):
+                        results = self._transaction(lane, path, writes)
+                else:
+                    results = self._transaction(lane, path, writes)
+            except Exception as e:
+                self._drop(lane, path)
+                busy = is_busy(e)
+                if not busy or attempt >= self.retries:
+                    # Only a lock is worth waiting out, and only for writes that must land
+                    failed = [job for job in writes if not (busy and job[4])]
+                    writes = [job for job in writes if busy and job[4]]
+                    if failed:
+                        self.logger.error(f"Failed to commit {len(failed)} writes to {path}: {e}")
+                    for job in failed:
+                        job[3].set_exception(e)
+                    if writes:
+                        self.logger.warning(
+                            f"{path} is still locked, retrying {len(writes)} writes "
+                            f"({lane.queue.qsize()} more queued)"
+                        )
+                if writes:
+                    time.sleep(min(self.max_backoff, 0.05 * 2 ** min(attempt, 10)))
+                    attempt += 1
+                continue
+
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+            break
+
+        for job in jobs:
+            if job[1] is None:
+                self._drop(lane, path)
+                job[3].set_result(None)
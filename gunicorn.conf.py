@@ -0,0 +1,12 @@
+"""Gunicorn settings for the Whoop integration service."""
+import os
+
+bind = '0.0.0.0:2008'
+
+# Load the app once in the master so workers fork with it already imported
+preload_app = os.getenv('GUNICORN_PRELOAD', 'true').lower() == 'true'
+
+def post_worker_init(worker):
+    # Threads don't survive fork, so each worker starts its own refresh loop
+    import app
+    app.start_background_refresh()
@@ -0,0 +1,107 @@
+"""Non-blocking, rate-limited logging.
+
+Records are handed to a bounded queue on the calling thread and written by a
+background listener, so slow handlers (file rotation, a busy console) never
+stall a request or refresh pass. Repeated warnings and errors from the same
+call site for the same user are collapsed: the first one in each window is
+logged and the rest are counted and reported with the next one that gets
+through.
+"""
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+from contextvars import ContextVar
+from logging.handlers import QueueHandler, QueueListener
+
+# User the current thread is working for, used to key deduplication
+current_user = ContextVar('current_user', default=None)
+
+
+class DedupeFilter(logging.Filter):
+    """Suppress repeats of the same warning or error within a time window.
+
+    Records are keyed by call site and current user, or by a ``dedupe_key``
+    passed through ``extra``. Records below ``level`` are never suppressed.
+    """
+
+    def __init__(self, window=300, level=logging.WARNING):
+        super().__init__()
+        self.window = window
+        self.level = level
+        self._seen = {}  # key -> [window start, suppressed count]
+        self._lock = threading.Lock()
+        self._last_prune = time.monotonic()
+
+    def filter(self, record):
+        if record.levelno < self.level or self.window <= 0:
+            return True
+        key = getattr(record, 'dedupe_key', None)
+        if key is None:
+            key = (record.pathname, record.lineno, current_user.get())
+
+        now = time.monotonic()
+        with self._lock:
+            self._prune(now)
+            entry = self._seen.get(key)
+            if entry and now - entry[0] < self.window:
+                entry[1] += 1
+                return False
+            suppressed = entry[1] if entry else 0
+            self._seen[key] = [now, 0]
+
+        if suppressed:
+            record.msg = f"{record.msg} (suppressed {suppressed} similar messages in the last {self.window}s)"
+        return True
+
+    def _prune(self, now):
+        if now - self._last_prune < self.window:
+            return
+        self._last_prune = now
+        # Entries whose window closed with nothing suppressed carry no information
+        expired = [key for key, (start, count) in self._seen.items()
+                   if now - start >= self.window and not count]
+        for key in expired:
+            del self._seen[key]
+
+
+class DroppingQueueHandler(QueueHandler):
+    """Queue handler that drops records instead of blocking when the queue is full."""
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def start_queue_logging(target, handlers, maxsize=10000, dedupe_window=300):
+    """Route ``target``'s records through a queue to ``handlers`` on a background thread.
+
+    Returns the listener. It is restarted in forked children (e.g. preloaded
+    gunicorn workers) and stopped at exit so queued records are flushed.
+    """
+    queue_handler = DroppingQueueHandler(queue.Queue(maxsize))
+    queue_handler.addFilter(DedupeFilter(window=dedupe_window))
+    listener = QueueListener(queue_handler.queue, *handlers, respect_handler_level=True)
+
+    target.addHandler(queue_handler)
+    target.propagate = False
+    listener.start()
+
+    def restart_in_child():
+        # The listener thread does not survive fork and the queue's locks may
+        # have been held by it, so the child gets a fresh queue and thread
+        queue_handler.queue = listener.queue = queue.Queue(maxsize)
+        listener._thread = None
+        listener.start()
+
+    os.register_at_fork(after_in_child=restart_in_child)
+    atexit.register(listener.stop)
+    return listener
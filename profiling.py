@@ -0,0 +1,147 @@
+"""Opt-in profiling for requests and background refresh passes.
+
+Modes:
+
+    off      nothing is recorded (default)
+    request  phase timings for every operation; a full cProfile only when a
+             request asks for one with ?profile=1 or an X-Profile: 1 header
+    sample   phase timings for every operation; a random fraction of
+             operations is fully profiled
+    all      every operation is fully profiled
+
+Phase timings break an operation down into named parts (upstream calls,
+JSON parsing, database writes, ...) and are kept for the most recent
+operations so the slowest ones can be listed. Full profiles are written to
+``output_dir`` as .prof files for pstats or snakeviz.
+"""
+import cProfile
+import os
+import random
+import re
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+MODES = ('off', 'request', 'sample', 'all')
+
+
+class Profiler:
+    """Records per-operation phase timings and optional cProfile dumps."""
+
+    def __init__(self, mode='off', sample_rate=0.01, output_dir=None, history=200, keep_files=50):
+        if mode not in MODES:
+            raise ValueError(f"Unknown profiling mode {mode!r}, expected one of {MODES}")
+        self.mode = mode
+        self.sample_rate = sample_rate
+        self.output_dir = output_dir
+        self.keep_files = keep_files
+        self._recent = deque(maxlen=history)
+        self._recent_lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def enabled(self):
+        return self.mode != 'off'
+
+    def should_profile(self, requested=False):
+        """Decide whether an operation gets a full cProfile."""
+        if self.mode == 'all':
+            return True
+        if self.mode == 'sample':
+            return random.random() < self.sample_rate
+        return self.mode == 'request' and requested
+
+    def begin(self, name, full=False):
+        """Start timing an operation on this thread.
+
+        Nested operations are folded into the outer one, so a refresh pass
+        is recorded once rather than once per user.
+        """
+        if not self.enabled or getattr(self._local, 'operation', None):
+            return False
+        operation = {
+            'name': name,
+            'started_at': datetime.now(timezone.utc).isoformat(),
+            'start': time.perf_counter(),
+            'phases': {},
+            'profile': None,
+        }
+        if full:
+            operation['profile'] = cProfile.Profile()
+            operation['profile'].enable()
+        self._local.operation = operation
+        return True
+
+    def end(self):
+        """Finish the current operation and record it."""
+        operation = getattr(self._local, 'operation', None)
+        if not operation:
+            return None
+        self._local.operation = None
+
+        duration = time.perf_counter() - operation['start']
+        profile_file = None
+        if operation['profile'] is not None:
+            operation['profile'].disable()
+            profile_file = self._dump(operation['name'], operation['profile'])
+
+        phases = {name: round(seconds * 1000, 2) for name, seconds in operation['phases'].items()}
+        phases['other'] = round(max(0.0, duration * 1000 - sum(phases.values())), 2)
+        record = {
+            'name': operation['name'],
+            'started_at': operation['started_at'],
+            'duration_ms': round(duration * 1000, 2),
+            'phases_ms': phases,
+            'profile_file': profile_file,
+        }
+        with self._recent_lock:
+            self._recent.append(record)
+        return record
+
+    @contextmanager
+    def operation(self, name, full=False):
+        started = self.begin(name, full)
+        try:
+            yield
+        finally:
+            if started:
+                self.end()
+
+    @contextmanager
+    def phase(self, name):
+        """Add the time spent in the block to a phase of the current operation."""
+        operation = getattr(self._local, 'operation', None) if self.enabled else None
+        if operation is None:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            phases = operation['phases']
+            phases[name] = phases.get(name, 0.0) + time.perf_counter() - start
+
+    def slowest(self, limit=20):
+        """Return the slowest recently recorded operations, slowest first."""
+        with self._recent_lock:
+            recent = list(self._recent)
+        return sorted(recent, key=lambda record: record['duration_ms'], reverse=True)[:limit]
+
+    def _dump(self, name, profile):
+        if not self.output_dir:
+            return None
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_') or 'operation'
+        filename = f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}-{slug}.prof"
+        profile.dump_stats(os.path.join(self.output_dir, filename))
+
+        # Only keep the newest dumps
+        dumps = sorted(f for f in os.listdir(self.output_dir) if f.endswith('.prof'))
+        for old in dumps[:-self.keep_files]:
+            try:
+                os.remove(os.path.join(self.output_dir, old))
+            except OSError:
+                pass
+        return filename
@@ -0,0 +1,67 @@
+import random
+import sqlite3
+
+import numpy as np
+import pytest
+
+from analytics import TrendAnalyzer
+
+
+@pytest.fixture
+def conn():
+    conn = sqlite3.connect(':memory:')
+    conn.executescript("""
+    CREATE TABLE cycles (id INTEGER PRIMARY KEY, whoop_id INTEGER);
+    CREATE TABLE recoveries (
+        cycle_id INTEGER PRIMARY KEY, sleep_id INTEGER, hrv_rmssd_milli REAL,
+        resting_heart_rate REAL, skin_temp_celsius REAL, spo2_percentage REAL
+    );
+    CREATE TABLE sleeps (id INTEGER PRIMARY KEY, respiratory_rate REAL);
+    """)
+    return conn
+
+
+def add_cycle(conn, cycle_id, rng, hrv=None):
+    conn.execute("INSERT INTO cycles VALUES (?, 1)", (cycle_id,))
+    conn.execute("INSERT INTO sleeps VALUES (?, ?)", (cycle_id, rng.gauss(15, 1)))
+    conn.execute("INSERT INTO recoveries VALUES (?, ?, ?, ?, ?, ?)", (
+        cycle_id, cycle_id, hrv if hrv is not None else rng.gauss(60, 5),
+        rng.gauss(55, 2), rng.gauss(33, 0.3), rng.gauss(97, 1),
+    ))
+
+
+def test_incremental_matches_full_recompute(conn):
+    rng = random.Random(1)
+    cached = TrendAnalyzer(window=10, min_periods=3)
+    for cycle_id in range(1, 41):
+        add_cycle(conn, cycle_id, rng, hrv=20 if cycle_id == 40 else None)
+        incremental = cached.summary(conn, 1)
+    assert incremental == TrendAnalyzer(window=10, min_periods=3).summary(conn, 1)
+    assert incremental['cycle_id'] == 40
+    assert incremental['metrics']['hrv_rmssd_milli']['anomaly']
+
+
+def test_cache_is_bounded(conn):
+    rng = random.Random(2)
+    analyzer = TrendAnalyzer(window=10, min_periods=3)
+    for cycle_id in range(1, 101):
+        add_cycle(conn, cycle_id, rng)
+    state = analyzer.update(conn, 1)
+    assert len(state['values']) == 11
+    assert state['values'].base is None  # Not a view pinning the full history
+
+
+def test_open_cycle_is_rescored(conn):
+    rng = random.Random(3)
+    analyzer = TrendAnalyzer(window=10, min_periods=3)
+    for cycle_id in range(1, 21):
+        add_cycle(conn, cycle_id, rng)
+    before = analyzer.summary(conn, 1)
+    conn.execute("UPDATE recoveries SET hrv_rmssd_milli = 10 WHERE cycle_id = 20")
+    after = analyzer.summary(conn, 1)
+    assert after['metrics']['hrv_rmssd_milli']['value'] == 10
+    assert after['metrics']['hrv_rmssd_milli']['z_score'] < before['metrics']['hrv_rmssd_milli']['z_score']
+    assert np.isclose(
+        after['metrics']['hrv_rmssd_milli']['baseline_mean'],
+        before['metrics']['hrv_rmssd_milli']['baseline_mean'],
+    )
@@ -0,0 +1,85 @@
+import pytest
+
+import app
+
+SNAPSHOT = {
+    'user_id': 7,
+    'timestamp': '2024-01-05T08:00:00+00:00',
+    'age_seconds': 30,
+    'upstream_status': 'closed',
+    'cycle_id': 1,
+    'cycle': {'id': 1, 'score': {'strain': 10.5, 'kilojoule': 8000}},
+    'recovery': {'cycle_id': 1, 'score': {'recovery_score': 60, 'hrv_rmssd_milli': 50}},
+    'sleep': {'id': 3, 'score': {'stage_summary': {'total_rem_sleep_time_milli': 1, 'disturbance_count': 2}}},
+    'workout': None,
+    'sleeps': [{'id': 3, 'start': 'a', 'score': {}}, {'id': 4, 'start': 'b', 'score': {}}],
+    'workouts': [],
+    'workout_summary': {'workout_count': 0},
+    'analytics': {'metrics': {'hrv': {'z_score': 1.0, 'baseline_mean': 40}}},
+}
+
+
+def with_changes(**changes):
+    snapshot = dict(SNAPSHOT)
+    snapshot.update(changes)
+    return snapshot
+
+
+def test_parse_fields():
+    fields = app.parse_data_fields('recovery.score.recovery_score, analytics.metrics.*.z_score,workout_summary,timestamp')
+    assert fields == {
+        'recovery': [['score', 'recovery_score']],
+        'analytics': [['metrics', '*', 'z_score']],
+        'workout_summary': [[]],
+    }
+    assert app.parse_data_fields(None) is None
+    with pytest.raises(ValueError):
+        app.parse_data_fields('nope.score')
+
+
+def test_project_fields():
+    assert app.project_fields(SNAPSHOT['analytics'], [['metrics', '*', 'z_score']]) == {
+        'metrics': {'hrv': {'z_score': 1.0}}
+    }
+    # Paths apply to every item of a list
+    assert app.project_fields(SNAPSHOT['sleeps'], [['id']]) == [{'id': 3}, {'id': 4}]
+    assert app.project_fields(None, [['score']]) is None
+
+
+def test_full_payload_without_since():
+    response = app.select_sections(SNAPSHOT)
+    assert set(response) == set(app.DATA_METADATA) | set(app.DATA_SECTIONS)
+    assert response['sleep'] == SNAPSHOT['sleep']
+    assert len(response['version']) == 8 * len(app.DATA_SECTIONS)
+
+
+def test_since_returns_only_changed_sections():
+    version = app.select_sections(SNAPSHOT)['version']
+    unchanged = app.select_sections(SNAPSHOT, since=version)
+    assert set(unchanged) == set(app.DATA_METADATA)
+    assert unchanged['version'] == version
+
+    recovery = {'cycle_id': 1, 'score': {'recovery_score': 70, 'hrv_rmssd_milli': 50}}
+    changed = app.select_sections(with_changes(recovery=recovery), since=version)
+    assert set(changed) == set(app.DATA_METADATA) | {'recovery'}
+    assert changed['recovery'] == recovery
+    assert changed['version'] != version
+
+
+def test_since_compares_projected_content():
+    fields = app.parse_data_fields('recovery.score.recovery_score')
+    snapshot = {key: SNAPSHOT[key] for key in app.DATA_METADATA if key in SNAPSHOT}
+    snapshot['recovery'] = SNAPSHOT['recovery']
+    version = app.select_sections(snapshot, fields)['version']
+
+    # A change outside the projection is not sent again
+    snapshot['recovery'] = {'cycle_id': 1, 'score': {'recovery_score': 60, 'hrv_rmssd_milli': 55}}
+    assert 'recovery' not in app.select_sections(snapshot, fields, version)
+
+    snapshot['recovery'] = {'cycle_id': 1, 'score': {'recovery_score': 65, 'hrv_rmssd_milli': 55}}
+    assert app.select_sections(snapshot, fields, version)['recovery'] == {'score': {'recovery_score': 65}}
+
+
+def test_unreadable_since_gets_full_payload():
+    response = app.select_sections(SNAPSHOT, since='garbage')
+    assert set(response) == set(app.DATA_METADATA) | set(app.DATA_SECTIONS)
@@ -0,0 +1,145 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from db_writer import BatchWriter, WriterBacklogError
+
+
+@pytest.fixture
+def writer():
+    writer = BatchWriter(max_delay=0.05, timeout=0.05, retries=2, max_backoff=0.05)
+    yield writer
+    writer.stop()
+
+
+def make_db(path):
+    with sqlite3.connect(path) as conn:
+        conn.execute("CREATE TABLE t (x INTEGER UNIQUE)")
+    return str(path)
+
+
+def insert(conn, x):
+    conn.execute("INSERT INTO t (x) VALUES (?)", (x,))
+    return x
+
+
+def values(path):
+    with sqlite3.connect(path) as conn:
+        return [row[0] for row in conn.execute("SELECT x FROM t ORDER BY rowid")]
+
+
+def test_writes_commit_in_order(tmp_path, writer):
+    path = make_db(tmp_path / 'a.db')
+    futures = [writer.submit(path, insert, x) for x in range(50)]
+    assert [future.result(timeout=5) for future in futures] == list(range(50))
+    assert values(path) == list(range(50))
+
+
+def test_failed_write_is_rolled_back_alone(tmp_path, writer):
+    path = make_db(tmp_path / 'a.db')
+
+    def insert_then_fail(conn):
+        insert(conn, 99)
+        raise ValueError("boom")
+
+    futures = [
+        writer.submit(path, insert, 1),
+        writer.submit(path, insert_then_fail),
+        writer.submit(path, insert, 1),  # Violates the unique constraint
+        writer.submit(path, insert, 2),
+    ]
+    assert futures[0].result(timeout=5) == 1
+    with pytest.raises(ValueError):
+        futures[1].result(timeout=5)
+    with pytest.raises(sqlite3.IntegrityError):
+        futures[2].result(timeout=5)
+    assert futures[3].result(timeout=5) == 2
+    assert values(path) == [1, 2]
+
+
+def test_locked_file_fails_after_retries(tmp_path, writer):
+    path = make_db(tmp_path / 'a.db')
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        with pytest.raises(sqlite3.OperationalError):
+            writer.submit(path, insert, 1).result(timeout=5)
+    finally:
+        blocker.execute("ROLLBACK")
+    assert writer.submit(path, insert, 2).result(timeout=5) == 2
+
+
+def test_must_land_write_waits_out_a_lock(tmp_path, writer):
+    path = make_db(tmp_path / 'a.db')
+    blocker = sqlite3.connect(path, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    future = writer.submit(path, insert, 1, must_land=True)
+    time.sleep(0.5)
+    assert not future.done()
+    blocker.execute("ROLLBACK")
+    assert future.result(timeout=5) == 1
+    assert values(path) == [1]
+
+
+def test_locked_file_does_not_hold_up_other_lanes(tmp_path):
+    writer = BatchWriter(timeout=0.05, max_backoff=0.05, dedicated=[str(tmp_path / 'catalog.db')])
+    catalog = make_db(tmp_path / 'catalog.db')
+    shard = make_db(tmp_path / 'shard.db')
+    blocker = sqlite3.connect(shard, isolation_level=None)
+    blocker.execute("BEGIN IMMEDIATE")
+    try:
+        stuck = writer.submit(shard, insert, 1, must_land=True)
+        assert writer.submit(catalog, insert, 1).result(timeout=1) == 1
+        assert not stuck.done()
+    finally:
+        blocker.execute("ROLLBACK")
+    stuck.result(timeout=5)
+    writer.stop()
+
+
+def test_connections_are_bounded_and_released(tmp_path):
+    writer = BatchWriter(workers=1, max_connections=3)
+    paths = [make_db(tmp_path / f'{i}.db') for i in range(10)]
+    for path in paths:
+        writer.submit(path, insert, 1).result(timeout=5)
+    lane = next(iter(writer._lanes.values()))
+    assert list(lane.connections) == paths[-3:]
+
+    writer.release(paths[-1]).result(timeout=5)
+    assert list(lane.connections) == paths[-3:-1]
+    writer.stop()
+
+
+def test_must_land_write_fails_on_other_errors(tmp_path, writer, monkeypatch):
+    path = make_db(tmp_path / 'a.db')
+
+    def broken(*args):
+        raise sqlite3.OperationalError("disk I/O error")
+
+    monkeypatch.setattr(writer, '_transaction', broken)
+    future = writer.submit(path, insert, 1, must_land=True)
+    with pytest.raises(sqlite3.OperationalError):
+        future.result(timeout=5)
+
+
+def test_full_lane_rejects_writes(tmp_path):
+    writer = BatchWriter(max_delay=0, max_queue=2, timeout=0.05)
+    path = make_db(tmp_path / 'a.db')
+    release = threading.Event()
+    started = threading.Event()
+
+    def block(conn):
+        started.set()
+        release.wait(5)
+
+    writer.submit(path, block)
+    started.wait(5)
+    queued = [writer.submit(path, insert, x) for x in range(3)]
+    with pytest.raises(WriterBacklogError):
+        queued[2].result(timeout=1)
+    assert sum(writer.depth().values()) == 2
+    release.set()
+    assert [future.result(timeout=5) for future in queued[:2]] == [0, 1]
+    writer.stop()